@@ -1,14 +1,23 @@
+import atexit
+import hashlib
+import io
 import json
 import os
 import queue
 import threading
-from typing import Callable, List, Optional
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
 
 from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 
-from core.llm import call_llm
-from core.schemas import AggregatedContext, TaskInput
+from core.cache import ResultCache, file_sha256
+from core.images import get_preview
+from core.llm import LLM_ERROR_PREFIX, call_llm, extract_json_object
+from core.schemas import AggregatedContext, ProgressEvent, StepResult, TaskInput
 from steps.ai_metadata_analyzer import AIMetadataAnalyzer
 from steps.base import BaseStep
 from steps.judge_system import JudgeSystem
@@ -19,23 +28,98 @@ from steps.visual_forensics import VisualForensicsAgent
 app = Flask(__name__, static_folder='frontend', static_url_path='')
 CORS(app)
 
-# Global queue for progress updates
-progress_queue = queue.Queue()
+# Seconds between SSE heartbeats while waiting for the next update
+HEARTBEAT_INTERVAL = 15
 
-def send_progress_update(event_type: str, data: dict):
+# Events after which the pipeline emits nothing more
+TERMINAL_EVENTS = ('complete', 'error')
+
+# Max buffered events per job, and how long a finished job's events are kept for a late client
+PROGRESS_QUEUE_SIZE = 128
+JOB_RETENTION = 10 * 60
+
+# Streamed answer text is only a preview (final_result carries all of it): when the queue
+# is full these are dropped instead of evicting step and lifecycle events
+BEST_EFFORT_EVENTS = ('final_token',)
+
+# Token deltas are batched into one event per this many seconds or characters
+TOKEN_FLUSH_INTERVAL = 0.25
+TOKEN_FLUSH_CHARS = 1024
+
+class ProgressChannel:
+    """Bounded progress queue of one job; drops the oldest event when full (or the new one, if best-effort)"""
+    
+    def __init__(self, maxsize: int = PROGRESS_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.finished_at: Optional[float] = None
+    
+    def put(self, event_type: str, payload: str):
+        while True:
+            try:
+                self.queue.put_nowait((event_type, payload))
+                break
+            except queue.Full:
+                if event_type in BEST_EFFORT_EVENTS:
+                    self.dropped += 1
+                    break
+                # Nobody is reading (client gone or slow): make room instead of growing
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+        if event_type in TERMINAL_EVENTS:
+            self.finished_at = time.time()
+    
+    def get(self, timeout: float):
+        return self.queue.get(timeout=timeout)
+
+# Pipelines run on a bounded pool; beyond MAX_PENDING_JOBS running + queued jobs, new ones get a 429
+PIPELINE_WORKERS = 8
+MAX_PENDING_JOBS = 32
+PIPELINE_POOL = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix='pipeline')
+PIPELINE_SLOTS = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+atexit.register(PIPELINE_POOL.shutdown, wait=False)
+
+# Progress channels of running analyses, keyed by job id
+JOBS: Dict[str, ProgressChannel] = {}
+JOBS_LOCK = threading.Lock()
+
+# Results for identical (image, text) inputs are reused for a day
+CACHE_TTL = 24 * 60 * 60
+STEP_CACHE = ResultCache('pipeline_steps', ttl=CACHE_TTL)
+FINAL_CACHE = ResultCache('final_judgment', ttl=CACHE_TTL)
+
+# Extensions kept on stored uploads (anything else is stored without one)
+UPLOAD_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff', '.heic'}
+
+def is_cacheable(result: StepResult) -> bool:
+    """Only successful step results are worth reusing"""
+    return result.success and result.content is not None
+
+def send_progress_update(channel: ProgressChannel, event_type: str, data: dict):
     """Send a progress update to the frontend"""
-    progress_queue.put({
-        'type': event_type,
-        'data': data
-    })
+    # Serialize once here; pydantic models in data (e.g. the full context) are dumped directly
+    payload = ProgressEvent(type=event_type, data=data).model_dump_json()
+    channel.put(event_type, payload)
 
-def run_pipeline(image_path: str, user_text: str = ""):
+def run_pipeline(image_path: str, user_text: str, channel: ProgressChannel, image_hash: Optional[str] = None):
     """Run the deepfake detection pipeline with progress callbacks"""
+    def send(event_type: str, data: dict):
+        send_progress_update(channel, event_type, data)
+    
     try:
         # Setup Context & Input
         task_input = TaskInput(image_path=image_path, text=user_text)
         context = AggregatedContext(task_input=task_input)
         
+        # Decode + downscale + encode once; the vision calls share these bytes
+        try:
+            get_preview(task_input)
+        except Exception as e:
+            print(f"Warning: Could not decode image preview: {e}")
+        
         # Register Steps
         steps: List[BaseStep] = [
             ReverseImageSearch(),
@@ -54,113 +138,169 @@ def run_pipeline(image_path: str, user_text: str = ""):
             'AIMetadataAnalyzer': 'Metadata Analysis'
         }
         
-        send_progress_update('start', {
+        send('start', {
             'message': 'Pipeline started',
             'total_steps': len(steps)
         })
         
-        # Sequential execution with progress updates
-        for idx, step in enumerate(steps):
-            step_name = step.__class__.__name__
-            display_name = step_names.get(step_name, step_name)
-            
-            send_progress_update('step_start', {
-                'step': step_name,
-                'display_name': display_name,
-                'step_number': idx + 1,
-                'total_steps': len(steps)
-            })
-            
-            try:
+        # Identical image bytes + text give identical results
+        input_key = f"{image_hash or file_sha256(image_path)}:{user_text}"
+        
+        # Steps are independent and I/O-bound, so run them concurrently
+        results_lock = threading.Lock()
+        
+        def run_step(step: BaseStep):
+            cache_key = f"{step.__class__.__name__}:{input_key}"
+            cached = STEP_CACHE.get(cache_key)
+            if cached is not None:
+                result = StepResult(**cached)
+            else:
                 result = step.run(task_input)
+                if is_cacheable(result):
+                    STEP_CACHE.set(cache_key, {
+                        'source': result.source,
+                        'content': result.content,
+                        'summary_for_prompt': result.summary_for_prompt
+                    })
+            
+            with results_lock:
                 context.results.append(result)
-                
-                # Format result for frontend
-                result_data = {
-                    'source': result.source,
-                    'content': result.content
-                }
-                
-                send_progress_update('step_complete', {
+            return result
+        
+        with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            futures = {}
+            for idx, step in enumerate(steps):
+                step_name = step.__class__.__name__
+                send('step_start', {
                     'step': step_name,
-                    'display_name': display_name,
-                    'result': result_data
+                    'display_name': step_names.get(step_name, step_name),
+                    'step_number': idx + 1,
+                    'total_steps': len(steps)
                 })
+                futures[executor.submit(run_step, step)] = step_name
+            
+            # Emit progress as each step returns
+            for future in as_completed(futures):
+                step_name = futures[future]
+                display_name = step_names.get(step_name, step_name)
                 
-            except Exception as e:
-                error_msg = str(e)
-                send_progress_update('step_error', {
-                    'step': step_name,
-                    'display_name': display_name,
-                    'error': error_msg
-                })
-                print(f"❌ error in step {step_name}: {e}")
+                try:
+                    result = future.result()
+                    
+                    # Format result for frontend
+                    result_data = {
+                        'source': result.source,
+                        'content': result.content
+                    }
+                    
+                    send('step_complete', {
+                        'step': step_name,
+                        'display_name': display_name,
+                        'result': result_data
+                    })
+                    
+                except Exception as e:
+                    error_msg = str(e)
+                    send('step_error', {
+                        'step': step_name,
+                        'display_name': display_name,
+                        'error': error_msg
+                    })
+                    print(f"❌ error in step {step_name}: {e}")
+        
+        # Keep the registration order so the final prompt (and its cache key) is stable
+        step_order = {step.__class__.__name__: idx for idx, step in enumerate(steps)}
+        context.results.sort(key=lambda r: step_order.get(r.source, len(steps)))
         
         # Final LLM Call
-        send_progress_update('final_analysis_start', {
+        send('final_analysis_start', {
             'message': 'Performing final analysis...'
         })
         
-        final_answer = call_llm(context)
+        final_key = hashlib.sha256((input_key + context.model_dump_json()).encode()).hexdigest()
+        final_answer = FINAL_CACHE.get(final_key)
+        if final_answer is None:
+            # Coalesce streamed chunks so a long answer doesn't flood the progress queue
+            token_buffer: List[str] = []
+            buffered_chars = 0
+            last_flush = time.monotonic()
+            
+            def flush_tokens():
+                nonlocal buffered_chars, last_flush
+                if token_buffer:
+                    send('final_token', {'delta': ''.join(token_buffer)})
+                    token_buffer.clear()
+                buffered_chars = 0
+                last_flush = time.monotonic()
+            
+            def on_token(text: str):
+                nonlocal buffered_chars
+                token_buffer.append(text)
+                buffered_chars += len(text)
+                if buffered_chars >= TOKEN_FLUSH_CHARS or time.monotonic() - last_flush >= TOKEN_FLUSH_INTERVAL:
+                    flush_tokens()
+            
+            final_answer = call_llm(context, on_chunk=on_token)
+            flush_tokens()
+            # A verdict drawn from failed steps must be recomputed once they succeed again
+            if not final_answer.startswith(LLM_ERROR_PREFIX) and all(is_cacheable(r) for r in context.results):
+                FINAL_CACHE.set(final_key, final_answer)
         
         try:
-            # Clean up JSON response - handle markdown code blocks
-            cleaned_answer = final_answer.strip()
-            if cleaned_answer.startswith('```'):
-                # Remove markdown code block markers
-                lines = cleaned_answer.split('\n')
-                # Remove first line if it's ```json or ```
-                if lines[0].startswith('```'):
-                    lines = lines[1:]
-                # Remove last line if it's ```
-                if lines and lines[-1].strip() == '```':
-                    lines = lines[:-1]
-                cleaned_answer = '\n'.join(lines).strip()
-            
-            data = json.loads(cleaned_answer)
+            data = json.loads(final_answer)
             
-            send_progress_update('final_result', {
+            send('final_result', {
                 'probability_score': data.get('probability_score'),
                 'explanation': data.get('explanation'),
-                'full_context': context.model_dump()
+                'full_context': context
             })
             
-        except json.JSONDecodeError as e:
+        except json.JSONDecodeError:
             # Try to extract JSON from the response if it's embedded in text
-            import re
-            json_match = re.search(r'\{[^{}]*"probability_score"[^{}]*\}', cleaned_answer, re.DOTALL)
-            if json_match:
-                try:
-                    data = json.loads(json_match.group())
-                    send_progress_update('final_result', {
-                        'probability_score': data.get('probability_score'),
-                        'explanation': data.get('explanation'),
-                        'full_context': context.model_dump()
-                    })
-                except:
-                    send_progress_update('final_result', {
-                        'probability_score': None,
-                        'explanation': final_answer,
-                        'raw_output': True,
-                        'full_context': context.model_dump()
-                    })
+            data = extract_json_object(final_answer, required_key='probability_score')
+            if data is not None:
+                send('final_result', {
+                    'probability_score': data.get('probability_score'),
+                    'explanation': data.get('explanation'),
+                    'full_context': context
+                })
             else:
-                send_progress_update('final_result', {
+                send('final_result', {
                     'probability_score': None,
                     'explanation': final_answer,
                     'raw_output': True,
-                    'full_context': context.model_dump()
+                    'full_context': context
                 })
         
-        send_progress_update('complete', {
+        send('complete', {
             'message': 'Pipeline completed successfully'
         })
         
     except Exception as e:
-        send_progress_update('error', {
+        send('error', {
             'error': str(e)
         })
 
+def start_job(image_path: str, user_text: str, image_hash: Optional[str] = None) -> Optional[str]:
+    """Register a progress queue for a new analysis and start its pipeline (None if the server is full)"""
+    if not PIPELINE_SLOTS.acquire(blocking=False):
+        return None
+    
+    job_id = uuid.uuid4().hex
+    channel = ProgressChannel()
+    now = time.time()
+    with JOBS_LOCK:
+        # Forget finished jobs whose client never came back for the events
+        for stale_id in [jid for jid, c in JOBS.items() if c.finished_at and now - c.finished_at > JOB_RETENTION]:
+            del JOBS[stale_id]
+        JOBS[job_id] = channel
+    
+    # Start pipeline on the shared pool; free the slot when it finishes
+    future = PIPELINE_POOL.submit(run_pipeline, image_path, user_text, channel, image_hash)
+    future.add_done_callback(lambda _: PIPELINE_SLOTS.release())
+    
+    return job_id
+
 @app.route('/')
 def index():
     """Serve the frontend"""
@@ -178,44 +318,69 @@ def analyze():
     if file.filename == '':
         return jsonify({'error': 'No image file selected'}), 400
     
-    # Save uploaded file temporarily
-    upload_dir = 'uploads'
-    os.makedirs(upload_dir, exist_ok=True)
+    # Save uploaded file under its content hash: never trust the client filename,
+    # and identical uploads share one file on disk
+    upload_dir = Path('uploads')
+    upload_dir.mkdir(exist_ok=True)
     
-    filepath = os.path.join(upload_dir, file.filename)
-    file.save(filepath)
+    # Only the extension of the client filename is kept, and only if it is a known image type
+    ext = Path(file.filename).suffix.lower()
+    if ext not in UPLOAD_EXTENSIONS:
+        ext = ''
+    digest = hashlib.sha256()
+    buffer = io.BytesIO()
+    for chunk in iter(lambda: file.stream.read(65536), b''):
+        digest.update(chunk)
+        buffer.write(chunk)
+    image_hash = digest.hexdigest()
     
-    # Clear the progress queue
-    while not progress_queue.empty():
-        try:
-            progress_queue.get_nowait()
-        except queue.Empty:
-            break
+    filepath = upload_dir / f'{image_hash}{ext}'
+    if not filepath.exists():
+        # Write to a temp name first so a concurrent reader never sees a partial file
+        tmp_path = upload_dir / f'{image_hash}.{uuid.uuid4().hex}.tmp'
+        tmp_path.write_bytes(buffer.getvalue())
+        os.replace(tmp_path, filepath)
     
-    # Start pipeline in background thread
-    thread = threading.Thread(target=run_pipeline, args=(filepath, user_text))
-    thread.daemon = True
-    thread.start()
+    job_id = start_job(str(filepath), user_text, image_hash)
+    if job_id is None:
+        return jsonify({'error': 'Too many analyses in progress, please retry shortly'}), 429
     
     return jsonify({
         'status': 'started',
+        'job_id': job_id,
         'message': 'Analysis started'
     })
 
-@app.route('/api/progress')
-def progress():
+@app.route('/api/progress/<job_id>')
+def progress(job_id: str):
     """Server-Sent Events endpoint for real-time progress updates"""
+    with JOBS_LOCK:
+        channel = JOBS.get(job_id)
+    if channel is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+    
     def generate():
         while True:
             try:
                 # Wait for progress update (with timeout)
-                update = progress_queue.get(timeout=1)
-                yield f"data: {json.dumps(update)}\n\n"
+                event_type, payload = channel.get(timeout=HEARTBEAT_INTERVAL)
             except queue.Empty:
                 # Send heartbeat to keep connection alive
-                yield ": heartbeat\n\n"
+                yield f": heartbeat dropped_events={channel.dropped}\n\n"
+                continue
+            
+            yield f"data: {payload}\n\n"
+            
+            # Release the worker as soon as the pipeline is done
+            if event_type in TERMINAL_EVENTS:
+                with JOBS_LOCK:
+                    JOBS.pop(job_id, None)
+                return
     
-    return Response(generate(), mimetype='text/event-stream')
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # don't let a reverse proxy buffer the stream
+    })
 
 @app.route('/api/upload-local', methods=['POST'])
 def upload_local():
@@ -227,20 +392,13 @@ def upload_local():
     if not image_path or not os.path.exists(image_path):
         return jsonify({'error': 'Invalid image path'}), 400
     
-    # Clear the progress queue
-    while not progress_queue.empty():
-        try:
-            progress_queue.get_nowait()
-        except queue.Empty:
-            break
-    
-    # Start pipeline in background thread
-    thread = threading.Thread(target=run_pipeline, args=(image_path, user_text))
-    thread.daemon = True
-    thread.start()
+    job_id = start_job(image_path, user_text)
+    if job_id is None:
+        return jsonify({'error': 'Too many analyses in progress, please retry shortly'}), 429
     
     return jsonify({
         'status': 'started',
+        'job_id': job_id,
         'message': 'Analysis started'
     })
 
@@ -0,0 +1,92 @@
+# core/cache.py
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import time
+from typing import Any, Iterator, Optional
+
+# Location of the shared on-disk cache (override with DEEPFAKE_CACHE_DIR)
+CACHE_DIR = os.getenv("DEEPFAKE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "deepfake"))
+CACHE_PATH = os.path.join(CACHE_DIR, "cache.sqlite")
+
+# Files at least this big are hashed through mmap (one C-level pass, no read loop or copies)
+MMAP_THRESHOLD = 8 * 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    """
+    Return the SHA-256 hex digest of a file's contents.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        else:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Small persistent key/value cache for JSON-serializable results.
+
+    Entries live in a single sqlite file shared by all namespaces and expire
+    after `ttl` seconds (never, if ttl is None). A new connection is opened per
+    operation, so one instance can be used from several threads.
+    """
+
+    def __init__(self, namespace: str, ttl: Optional[float] = None, path: str = CACHE_PATH):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT, key TEXT, value TEXT, created REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None on a miss or expired entry."""
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value, created FROM entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Warning: cache lookup failed: {e}")
+            return None
+
+        if row is None:
+            return None
+        value, created = row
+        if self.ttl is not None and time.time() - created > self.ttl:
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a JSON-serializable value under key."""
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (namespace, key, value, created) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, json.dumps(value, default=str), time.time())
+                )
+        except sqlite3.Error as e:
+            print(f"Warning: cache write failed: {e}")
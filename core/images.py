@@ -0,0 +1,86 @@
+# core/images.py
+import functools
+import hashlib
+import io
+import os
+from typing import Any, Dict, Tuple
+
+import PIL.Image
+
+from core.cache import MMAP_THRESHOLD, file_sha256
+from core.schemas import TaskInput
+
+# Largest size the Gemini vision calls need; bigger images are downscaled once
+PREVIEW_MAX_SIZE: Tuple[int, int] = (1024, 1024)
+PREVIEW_MIME_TYPE = "image/jpeg"
+# Raw files kept in memory; a pipeline run only touches one image, so a few is plenty
+RAW_CACHE_SIZE = 8
+
+
+@functools.lru_cache(maxsize=RAW_CACHE_SIZE)
+def _read_file(path: str, mtime_ns: int, size: int) -> bytes:
+    # mtime and size are only part of the cache key, so a rewritten file is read again
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def read_image_bytes(image_path: str) -> bytes:
+    """
+    Return the raw bytes of an image file.
+
+    Memoized on (absolute path, mtime, size), so the steps of one pipeline run
+    (preview, hashing, upload, ...) share a single read of the file. Files of
+    MMAP_THRESHOLD and up are read fresh instead, so the cache never pins them.
+    """
+    stat = os.stat(image_path)
+    if stat.st_size >= MMAP_THRESHOLD:
+        with open(image_path, "rb") as f:
+            return f.read()
+    return _read_file(os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+
+
+def image_sha256(image_path: str) -> str:
+    """
+    SHA-256 hex digest of an image file.
+
+    Small files are hashed from the memoized bytes; large ones are hashed via
+    mmap without loading them into memory.
+    """
+    if os.path.getsize(image_path) >= MMAP_THRESHOLD:
+        return file_sha256(image_path)
+    return hashlib.sha256(read_image_bytes(image_path)).hexdigest()
+
+
+def load_preview(image_path: str, max_size: Tuple[int, int] = PREVIEW_MAX_SIZE) -> bytes:
+    """
+    Decode an image once, downscale it to the size the vision models need and
+    encode it as JPEG.
+
+    The bytes are sent to Gemini as-is, so the SDK doesn't re-encode a PIL image
+    on every request.
+    """
+    # Large files are decoded straight from disk rather than from an in-memory copy
+    if os.path.getsize(image_path) >= MMAP_THRESHOLD:
+        source = image_path
+    else:
+        source = io.BytesIO(read_image_bytes(image_path))
+
+    with PIL.Image.open(source) as img:
+        # JPEG can decode straight at a reduced scale
+        img.draft("RGB", max_size)
+        preview = img.convert("RGB")
+    preview.thumbnail(max_size, PIL.Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    preview.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def get_preview(task_input: TaskInput) -> Dict[str, Any]:
+    """
+    Return the shared preview of the task image as a Gemini inline blob,
+    encoding it on first use.
+    """
+    if task_input.image_bytes is None:
+        task_input.image_bytes = load_preview(task_input.image_path)
+    return {"mime_type": PREVIEW_MIME_TYPE, "data": task_input.image_bytes}
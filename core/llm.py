@@ -1,48 +1,212 @@
+import asyncio
+import functools
+import hashlib
+import io
 import os
 import json
+import threading
+import time
 import google.generativeai as genai
 from dotenv import load_dotenv
+from core.images import get_preview
 from core.schemas import AggregatedContext
 
-from typing import List, Any, Optional
+from typing import Callable, Dict, List, Any, Optional, Tuple
 
 load_dotenv()
 
-def query_llm(prompt: str, images: Optional[List[Any]] = None) -> str:
+# Model used for all text/vision queries (override with GEMINI_MODEL)
+MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+
+# The one key every google.generativeai call in the process uses (GOOGLE_API_KEY as a
+# fallback for setups that only define that); resolved once at import
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+
+_CONFIGURED = False
+_CONFIGURE_LOCK = threading.Lock()
+
+def configure_genai() -> None:
     """
-    Generic function to query the Gemini API with a given prompt and optional images.
+    Configure google.generativeai with GEMINI_API_KEY, once per process.
+
+    genai.configure replaces the process-wide client and with it the open
+    channel, so every caller goes through here instead of configuring its own key.
+    """
+    global _CONFIGURED
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY (or GOOGLE_API_KEY) not found in environment variables.")
+    with _CONFIGURE_LOCK:
+        if not _CONFIGURED:
+            genai.configure(api_key=GEMINI_API_KEY)
+            _CONFIGURED = True
+
+@functools.lru_cache(maxsize=4)
+def _get_model(name: str) -> Any:
+    """
+    Build the model once per model name.
+    """
+    configure_genai()
+    return genai.GenerativeModel(name)
+
+# Send images through the Gemini Files API (opt-in: VF_FILES_API=1), for every step that
+# can; uploads are keyed by content hash, so re-sending the same image reuses the handle
+FILES_API_ENABLED = os.getenv("VF_FILES_API", "").lower() in ("1", "true", "yes")
+
+# Files API uploads expire after 48 hours on Google's side; re-upload a bit before that
+UPLOAD_TTL = 46 * 3600
+_UPLOADS: Dict[str, Tuple[Any, float]] = {}
+_UPLOADS_LOCK = threading.Lock()
+
+def upload_blob(blob: Dict[str, Any]) -> Any:
+    """
+    Upload an inline blob ({"mime_type", "data"}) through the Gemini Files API and
+    return the file handle, reusing an earlier upload of the same bytes.
+
+    Callers that send the same image in many requests can pass the handle in
+    `images` instead of re-sending the bytes every time.
+    """
+    configure_genai()
+
+    digest = hashlib.sha256(blob["data"]).hexdigest()
+    with _UPLOADS_LOCK:
+        cached = _UPLOADS.get(digest)
+    if cached is not None and time.time() - cached[1] < UPLOAD_TTL:
+        return cached[0]
+
+    uploaded = genai.upload_file(io.BytesIO(blob["data"]), mime_type=blob["mime_type"])
+    with _UPLOADS_LOCK:
+        _UPLOADS[digest] = (uploaded, time.time())
+    return uploaded
+
+def strip_code_fences(text: str) -> str:
     """
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        return "Error: GEMINI_API_KEY not found in environment variables."
+    Remove a markdown code fence (```json ... ```) wrapping the whole response.
+    """
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        # Drop the opening ```/```json line and a closing ``` line
+        lines = cleaned.split("\n")[1:]
+        if lines and lines[-1].strip() == "```":
+            lines = lines[:-1]
+        cleaned = "\n".join(lines).strip()
+    return cleaned
+
+def chunk_text(chunk: Any) -> str:
+    """
+    Text of one streamed response chunk, "" for chunks without text parts.
+
+    chunk.text raises ValueError on chunks that carry no parts (e.g. a final
+    chunk with only the finish reason or safety ratings), so read the parts directly.
+    """
+    if not chunk.candidates:
+        return ""
+    return "".join(part.text for part in chunk.candidates[0].content.parts if part.text)
 
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.0-flash')
+# Prefix of the string query_llm returns instead of raising when the request fails
+LLM_ERROR_PREFIX = "Error calling Gemini API"
+
+def query_llm(prompt: str, images: Optional[List[Any]] = None, on_chunk: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Generic function to query the Gemini API with a given prompt and optional images.
+    If on_chunk is given, the response is streamed and each text chunk is passed to it as it arrives.
+    Returns the response text with any wrapping markdown code fence removed.
+    """
+    model = _get_model(MODEL)
 
     try:
         content = [prompt]
         if images:
             content.extend(images)
             
-        response = model.generate_content(content)
-        return response.text
+        if on_chunk is None:
+            response = model.generate_content(content)
+            return strip_code_fences(response.text)
+
+        chunks = []
+        for chunk in model.generate_content(content, stream=True):
+            text = chunk_text(chunk)
+            if text:
+                chunks.append(text)
+                on_chunk(text)
+        return strip_code_fences("".join(chunks))
     except Exception as e:
-        return f"Error calling Gemini API: {e}"
+        return f"{LLM_ERROR_PREFIX}: {e}"
 
-import PIL.Image
+def extract_json_object(text: str, required_key: Optional[str] = None) -> Optional[dict]:
+    """
+    Return the first balanced top-level {...} object in text that parses as JSON
+    (and contains required_key, if given), or None.
 
-def call_llm(context: AggregatedContext) -> str:
+    Single pass over the text, tracking brace depth and string/escape state, so
+    braces inside string values don't confuse the scan.
+    """
+    start = -1
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            if depth > 0:
+                in_string = True
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                try:
+                    candidate = json.loads(text[start:i + 1])
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(candidate, dict) and (required_key is None or required_key in candidate):
+                    return candidate
+
+    return None
+
+def _prompt_context(context: AggregatedContext) -> str:
+    """
+    Compact JSON of the context for the prompt. Steps with large raw output can
+    set summary_for_prompt; the full content still goes to the frontend.
+    """
+    results = []
+    for result in context.results:
+        results.append({
+            "source": result.source,
+            "content": result.content if result.summary_for_prompt is None else result.summary_for_prompt
+        })
+    payload = {"task_input": context.task_input.model_dump(mode="json"), "results": results}
+    return json.dumps(payload, separators=(",", ":"), default=str)
+
+# Shared by call_llm and call_llm_batch (indented to sit inside their prompt text)
+_JUDGE_INSTRUCTIONS = """1. **Synthesize Evidence**: Combine your own visual analysis of the image with the findings from the tools. Look for inconsistencies, artifacts, metadata anomalies, and logical flaws.
+    2. **Weigh the Tools**: 
+       - `SynthIDDetection` and `VisualForensicsAgent` are high-signal tools.
+       - `JudgeSystem` provides a debate summary.
+       - `ReverseImageSearch` helps identify context.
+    3. **Determine Probability**: Assign a score from 0 to 100 (0 = Definitely Real, 100 = Definitely Fake).
+    4. **Explain**: Provide a clear, professional explanation citing specific evidence."""
+
+def call_llm(context: AggregatedContext, on_chunk: Optional[Callable[[str], None]] = None) -> str:
     """
     Calls the Gemini API to analyze the context and return a deepfake probability and explanation.
+    Pass on_chunk to receive the raw response text incrementally while it is generated.
     """
-    context_json = context.model_dump_json(indent=2)
+    context_json = _prompt_context(context)
     
     # Try to load the image
-    image_path = context.task_input.image_path
     img = None
     try:
-        if image_path:
-            img = PIL.Image.open(image_path)
+        if context.task_input.image_path:
+            img = get_preview(context.task_input)
     except Exception as e:
         print(f"Warning: Could not load image for final judgment: {e}")
 
@@ -57,13 +221,7 @@ def call_llm(context: AggregatedContext) -> str:
     {context_json}
     
     ### Instructions
-    1. **Synthesize Evidence**: Combine your own visual analysis of the image with the findings from the tools. Look for inconsistencies, artifacts, metadata anomalies, and logical flaws.
-    2. **Weigh the Tools**: 
-       - `SynthIDDetection` and `VisualForensicsAgent` are high-signal tools.
-       - `JudgeSystem` provides a debate summary.
-       - `ReverseImageSearch` helps identify context.
-    3. **Determine Probability**: Assign a score from 0 to 100 (0 = Definitely Real, 100 = Definitely Fake).
-    4. **Explain**: Provide a clear, professional explanation citing specific evidence.
+    {_JUDGE_INSTRUCTIONS}
     
     ### Output Format
     Return a valid JSON object with EXACTLY this structure:
@@ -74,8 +232,77 @@ def call_llm(context: AggregatedContext) -> str:
     Do not include markdown formatting like ```json.
     """
 
-    response_text = query_llm(prompt, images=[img] if img else None)
+    return query_llm(prompt, images=[img] if img else None, on_chunk=on_chunk)
+
+async def call_llm_async(context: AggregatedContext) -> str:
+    """
+    call_llm for asyncio callers. The SDK call blocks, so it runs in a worker thread
+    and many contexts can be awaited together.
+    """
+    return await asyncio.to_thread(call_llm, context)
+
+# Contexts per call_llm_batch request; beyond this the reply gets long and per-item quality drops
+MAX_BATCH_SIZE = 16
+
+def call_llm_batch(contexts: List[AggregatedContext]) -> List[str]:
+    """
+    Like call_llm for several contexts, with one Gemini request per MAX_BATCH_SIZE items.
+    Returns one JSON string per context, in order. Items missing from the batched
+    reply are retried on their own with call_llm.
+    """
+    results: List[str] = []
+    for offset in range(0, len(contexts), MAX_BATCH_SIZE):
+        results.extend(_call_llm_chunk(contexts[offset:offset + MAX_BATCH_SIZE]))
+    return results
+
+def _call_llm_chunk(contexts: List[AggregatedContext]) -> List[str]:
+    sections = []
+    images = []
+    for i, context in enumerate(contexts, 1):
+        img = None
+        try:
+            if context.task_input.image_path:
+                img = get_preview(context.task_input)
+        except Exception as e:
+            print(f"Warning: Could not load image for item {i}: {e}")
+        if img is not None:
+            images.extend([f"Image for Item {i}:", img])
+        sections.append(f"### Item {i}\n{_prompt_context(context)}")
+    items_text = "\n\n".join(sections)
+
+    prompt = f"""
+    You are a world-class Digital Forensics Expert and Deepfake Detection System.
+    
+    Your task is to analyze {len(contexts)} independent items. Each item has an image (attached and labeled with its item number, if available) and the results from various forensic tools. For each item, determine the probability that the content is AI-generated (a deepfake).
     
-    # Clean up potential markdown code blocks
-    cleaned_response = response_text.replace("```json", "").replace("```", "").strip()
-    return cleaned_response
+    ### Items
+    {items_text}
+    
+    ### Instructions (apply to each item separately)
+    {_JUDGE_INSTRUCTIONS}
+    
+    ### Output Format
+    For each item i, in order, output a line "### Result i" followed by a valid JSON object with EXACTLY this structure:
+    {{
+        "probability_score": <int between 0 and 100>,
+        "explanation": "<string explanation>"
+    }}
+    Do not include markdown formatting like ```json.
+    """
+
+    response = query_llm(prompt, images=images or None)
+    if response.startswith(LLM_ERROR_PREFIX):
+        # e.g. a 429: retrying every item on its own would only send more requests into it
+        return [response] * len(contexts)
+
+    parsed: Dict[int, dict] = {}
+    for block in response.split("### Result ")[1:]:
+        number, _, body = block.partition("\n")
+        data = extract_json_object(body, required_key="probability_score")
+        if number.strip().isdigit() and data is not None:
+            parsed[int(number.strip())] = data
+
+    return [
+        json.dumps(parsed[i]) if i in parsed else call_llm(context)
+        for i, context in enumerate(contexts, 1)
+    ]
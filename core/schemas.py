@@ -1,18 +1,40 @@
 # core/schemas.py
-from pydantic import BaseModel
-from typing import List, Optional, Any
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, Any
 
 # Input for all steps in pipeleine
 class TaskInput(BaseModel):
     image_path: str
     text: Optional[str] = None
+    # downscaled JPEG of the image shared by all steps (see core.images); never serialized
+    image_bytes: Optional[bytes] = Field(default=None, exclude=True)
 
 # return value of single step
 class StepResult(BaseModel):
     source: str
     content: Any # STRING OR JSON
+    summary_for_prompt: Optional[Any] = None # smaller stand-in for content in the final LLM prompt
+    success: bool = True # False when the step failed (content then describes the error); failures are never cached
 
 # collected context for final llm call
 class AggregatedContext(BaseModel):
     task_input: TaskInput
-    results: List[StepResult] = []
\ No newline at end of file
+    results: List[StepResult] = []
+# progress update streamed to the frontend (serialized once, in pydantic-core)
+class ProgressEvent(BaseModel):
+    type: str
+    data: Dict[str, Any]
+
+# one artifact flagged by the visual forensics agent
+class FlaggedArtifact(BaseModel):
+    indicator_type: str # one of the 5 indicator names
+    location: str
+    description: str
+    severity: float # 0.0 = minor, 1.0 = smoking gun
+
+# structured output of the visual forensics agent (also sent to Gemini as response_schema)
+class VisualForensicsResult(BaseModel):
+    fake_probability: float
+    confidence: float
+    reasoning_summary: str
+    flagged_artifacts: List[FlaggedArtifact]
@@ -3,6 +3,7 @@ let eventSource = null;
 let currentSteps = [];
 let completedSteps = 0;
 let totalSteps = 0;
+let streamedAnswer = '';
 
 // DOM elements
 const uploadBox = document.getElementById('uploadBox');
@@ -89,8 +90,10 @@ analyzeBtn.addEventListener('click', async () => {
             throw new Error('Failed to start analysis');
         }
 
+        const { job_id: jobId } = await response.json();
+
         // Connect to SSE stream
-        connectToProgressStream();
+        connectToProgressStream(jobId);
 
     } catch (error) {
         console.error('Error:', error);
@@ -104,6 +107,7 @@ function resetUI() {
     completedSteps = 0;
     totalSteps = 0;
     currentSteps = [];
+    streamedAnswer = '';
     toolsGrid.innerHTML = '';
 
     // Initialize tool cards
@@ -165,12 +169,12 @@ function formatToolContent(content) {
     return String(content);
 }
 
-function connectToProgressStream() {
+function connectToProgressStream(jobId) {
     if (eventSource) {
         eventSource.close();
     }
 
-    eventSource = new EventSource('/api/progress');
+    eventSource = new EventSource(`/api/progress/${jobId}`);
 
     eventSource.onmessage = (event) => {
         try {
@@ -217,6 +221,12 @@ function handleProgressUpdate(update) {
             currentStep.textContent = 'Performing final analysis...';
             break;
 
+        case 'final_token':
+            // Show the raw answer while it streams in; final_result replaces it
+            streamedAnswer += data.delta;
+            explanationText.textContent = streamedAnswer;
+            break;
+
         case 'final_result':
             displayFinalResult(data);
             break;
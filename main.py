@@ -1,8 +1,10 @@
 # main.py
 import argparse
+import asyncio
 import json
 from typing import List
 
+from core.images import get_preview
 from core.llm import call_llm
 from core.schemas import AggregatedContext, TaskInput
 from steps.base import BaseStep
@@ -12,14 +14,34 @@ from steps.visual_forensics import VisualForensicsAgent
 from steps.judge_system import JudgeSystem
 from steps.ai_metadata_analyzer import AIMetadataAnalyzer
 
+# Alle verfügbaren Steps, in Ausführungsreihenfolge
+STEP_CLASSES = {
+    cls.__name__: cls
+    for cls in (ReverseImageSearch, SynthIDDetection, VisualForensicsAgent, JudgeSystem, AIMetadataAnalyzer)
+}
+
+async def run_steps(steps: List[BaseStep], task_input: TaskInput) -> List:
+    """Run all steps concurrently; failed steps yield their exception."""
+    return await asyncio.gather(
+        *(step.run_async(task_input) for step in steps),
+        return_exceptions=True
+    )
+
 def main():
     # 1. User Input (Simuliert oder via CLI)
     parser = argparse.ArgumentParser(description="Hackathon Gemini Pipeline")
     parser.add_argument("--img", type=str, default="./example_data/anypic.png", help="Path to the image file")
     parser.add_argument("--text", type=str, default="instagram", help="instagram picture")
+    parser.add_argument("--steps", type=str, default=",".join(STEP_CLASSES),
+                        help=f"Comma-separated subset of steps to run (available: {', '.join(STEP_CLASSES)})")
     
     args = parser.parse_args()
     
+    step_names = [name.strip() for name in args.steps.split(",") if name.strip()]
+    unknown = [name for name in step_names if name not in STEP_CLASSES]
+    if unknown:
+        parser.error(f"unknown step(s): {', '.join(unknown)}")
+    
     image_path = args.img
     user_text = args.text
     
@@ -28,25 +50,23 @@ def main():
     # 2. Setup Context & Input
     task_input = TaskInput(image_path=image_path, text=user_text)
     context = AggregatedContext(task_input=task_input)
+    try:
+        get_preview(task_input)  # einmal dekodieren, von allen Steps geteilt
+    except Exception as e:
+        print(f"Warning: Could not decode image preview: {e}")
     
     # 3. Registriere Steps
-    steps: List[BaseStep] = [
-        ReverseImageSearch(),
-        SynthIDDetection(),
-        VisualForensicsAgent(),
-        JudgeSystem(),
-        AIMetadataAnalyzer()
-    ]
+    steps: List[BaseStep] = [STEP_CLASSES[name]() for name in step_names]
     
-    # 4. Sequenzielle Ausführung
-    for step in steps:
-        try:
-            result = step.run(task_input)
-            context.results.append(result)
-            print(f"✅ {result.source} done.")
-            print(result.content)
-        except Exception as e:
-            print(f"❌ error in step {step.__class__.__name__}: {e}")
+    # 4. Parallele Ausführung (alle Steps sind unabhängig voneinander)
+    results = asyncio.run(run_steps(steps, task_input))
+    for step, result in zip(steps, results):
+        if isinstance(result, Exception):
+            print(f"❌ error in step {step.__class__.__name__}: {result}")
+            continue
+        context.results.append(result)
+        print(f"✅ {result.source} done.")
+        print(result.content)
 
     # 5. Finaler LLM Call
     print("\n--- FINAL LLM CALL ---")
@@ -1,7 +1,11 @@
-from steps.base import BaseStep
+from steps.base import BaseStep, BatchStep
+from core.cache import ResultCache
 from core.schemas import TaskInput, StepResult
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
+import functools
 import os
+import struct
+import zlib
 
 try:
     from sd_parsers import ParserManager, Eagerness
@@ -10,8 +14,143 @@ try:
 except ImportError:
     SD_PARSERS_AVAILABLE = False
 
+# Parsed metadata keyed by (absolute path, mtime, size), shared across runs
+_META_CACHE = ResultCache('ai_metadata')
 
-class AIMetadataAnalyzer(BaseStep):
+@functools.lru_cache(maxsize=1)
+def _get_parser_manager() -> "ParserManager":
+    """
+    Shared ParserManager, built on first use.
+
+    Building one initializes the whole parser registry, so all analyzer
+    instances (and threads) reuse a single manager.
+    """
+    # DEFAULT mode (balanced performance/thoroughness)
+    return ParserManager(eagerness=Eagerness.DEFAULT)
+
+
+# Formats sd-parsers can find generation parameters in
+SD_METADATA_FORMATS = {'PNG', 'JPEG', 'WEBP'}
+
+# Insightful EXIF tags to look for
+# 271: Make, 272: Model, 305: Software, 306: DateTime
+# 36867: DateTimeOriginal, 36868: DateTimeDigitized
+# 42034: LensModel, 37510: UserComment
+INSIGHTFUL_EXIF_TAGS = {
+    271: 'Make',
+    272: 'Model',
+    305: 'Software',
+    306: 'DateTime',
+    36867: 'DateTimeOriginal',
+    36868: 'DateTimeDigitized',
+    42034: 'LensModel',
+    37510: 'UserComment',
+    33432: 'Copyright',
+    315: 'Artist'
+}
+
+# Tag in IFD0 that points at the Exif sub-IFD
+EXIF_IFD_POINTER = 0x8769
+
+# Also potentially interesting, looked up by their standard ExifTags name
+EXTRA_EXIF_TAG_NAMES = ('BodySerialNumber', 'CameraOwnerName', 'LensSpecification')
+
+
+@functools.lru_cache(maxsize=1)
+def _wanted_exif_tags() -> Dict[int, str]:
+    """
+    Single tag-id -> name map for every EXIF tag we report.
+
+    Names from INSIGHTFUL_EXIF_TAGS win where ids overlap.
+    """
+    from PIL import ExifTags
+
+    extra = {tag_id: name for tag_id, name in ExifTags.TAGS.items() if name in EXTRA_EXIF_TAG_NAMES}
+    return {**extra, **INSIGHTFUL_EXIF_TAGS}
+
+
+# Large binary blobs in img.info that are never useful as text
+SKIPPED_INFO_KEYS = {'icc_profile', 'exif'}
+# Longer bytes values are binary payloads (thumbnails etc.), not text
+MAX_INFO_BYTES = 1000
+
+
+def _info_text(value: Any) -> Optional[str]:
+    """Text form of an img.info value, or None if it should be left out of the report."""
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    if isinstance(value, bytes) and len(value) < MAX_INFO_BYTES:
+        try:
+            return value.decode()
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_TEXT_CHUNKS = (b'tEXt', b'zTXt', b'iTXt')
+# Upper bound for a single decompressed text chunk (same spirit as Pillow's MAX_TEXT_CHUNK)
+PNG_MAX_TEXT_SIZE = 1024 * 1024
+
+
+def _inflate(data: bytes) -> bytes:
+    """Decompress a zlib stream, refusing to expand past PNG_MAX_TEXT_SIZE."""
+    return zlib.decompressobj().decompress(data, PNG_MAX_TEXT_SIZE)
+
+
+def _scan_png_metadata(image_path: str) -> Tuple[Dict[str, str], Optional[bytes]]:
+    """
+    Read the text chunks and the raw eXIf payload of a PNG by walking its chunk list.
+
+    IDAT chunks are skipped with a seek, so nothing is decompressed. Pillow's
+    getexif() on a PNG calls load() and decodes every pixel just to find
+    chunks that sit after the image data.
+    """
+    text: Dict[str, str] = {}
+    exif: Optional[bytes] = None
+
+    with open(image_path, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError("Not a PNG file")
+
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'IEND':
+                break
+            if chunk_type not in PNG_TEXT_CHUNKS and chunk_type != b'eXIf':
+                f.seek(length + 4, os.SEEK_CUR)  # data + CRC
+                continue
+
+            data = f.read(length)
+            f.seek(4, os.SEEK_CUR)  # CRC
+
+            if chunk_type == b'eXIf':
+                exif = data
+                continue
+
+            key, _, rest = data.partition(b'\0')
+            try:
+                if chunk_type == b'tEXt':
+                    value = rest.decode('latin-1')
+                elif chunk_type == b'zTXt':
+                    value = _inflate(rest[1:]).decode('latin-1')
+                else:
+                    # iTXt: compression flag, method, language\0, translated keyword\0, text
+                    compressed = rest[:1] == b'\1'
+                    _lang, _, rest = rest[2:].partition(b'\0')
+                    _translated, _, value_bytes = rest.partition(b'\0')
+                    value = (_inflate(value_bytes) if compressed else value_bytes).decode('utf-8')
+            except (zlib.error, UnicodeDecodeError):
+                continue
+            text[key.decode('latin-1')] = value
+
+    return text, exif
+
+
+class AIMetadataAnalyzer(BatchStep, BaseStep):
     """
     Analyzes images for AI-generation metadata using sd-parsers library.
     Returns a raw metadata report for further analysis by an LLM.
@@ -21,10 +160,6 @@ class AIMetadataAnalyzer(BaseStep):
         """Initialize the AI metadata analyzer with sd-parsers."""
         if not SD_PARSERS_AVAILABLE:
             print("  [AIMetadataAnalyzer] Warning: sd-parsers not installed. Run: pip install sd-parsers")
-            self.parser_manager = None
-        else:
-            # Initialize ParserManager with DEFAULT mode (balanced performance/thoroughness)
-            self.parser_manager = ParserManager(eagerness=Eagerness.DEFAULT)
 
     def run(self, input_data: TaskInput) -> StepResult:
         """
@@ -46,26 +181,46 @@ class AIMetadataAnalyzer(BaseStep):
                     'status': 'error',
                     'error_type': 'dependency_missing',
                     'message': 'sd-parsers library not installed. Run: pip install sd-parsers'
-                }
+                },
+                success=False
             )
 
-        # Validate file exists
-        if not os.path.exists(input_data.image_path):
+        # Validate file exists (one stat serves the check, the cache key and the file size)
+        try:
+            file_stats = os.stat(input_data.image_path)
+        except FileNotFoundError:
             return StepResult(
                 source="AIMetadataAnalyzer",
                 content={
                     'status': 'error',
                     'error_type': 'file_not_found',
                     'message': f'Image file not found: {input_data.image_path}'
-                }
+                },
+                success=False
             )
 
         try:
-            # 1. Extract SD/AI Metadata
-            sd_metadata = self._extract_sd_metadata(input_data.image_path)
+            # Identical path + mtime + size means the metadata can't have changed
+            cache_key = f"{os.path.abspath(input_data.image_path)}:{file_stats.st_mtime_ns}:{file_stats.st_size}"
+            cached = _META_CACHE.get(cache_key)
 
-            # 2. Extract File System / Basic Image Metadata
-            file_metadata = self._extract_file_metadata(input_data.image_path)
+            if cached is not None:
+                sd_metadata = cached['sd_parsers_report']
+                file_metadata = cached['file_system_report']
+            else:
+                # Open once and hand the same (lazily decoded) image to both extractors
+                with Image.open(input_data.image_path) as img:
+                    # 1. Extract SD/AI Metadata
+                    sd_metadata = self._extract_sd_metadata(img)
+
+                    # 2. Extract File System / Basic Image Metadata
+                    file_metadata = self._extract_file_metadata(img, file_stats)
+
+                if 'error' not in sd_metadata and 'error' not in file_metadata:
+                    _META_CACHE.set(cache_key, {
+                        'sd_parsers_report': sd_metadata,
+                        'file_system_report': file_metadata
+                    })
 
             # Combine into a raw report
             content = {
@@ -86,62 +241,65 @@ class AIMetadataAnalyzer(BaseStep):
                     'status': 'error',
                     'error_type': 'unexpected_error',
                     'message': str(e)
-                }
+                },
+                success=False
             )
 
-    def _extract_sd_metadata(self, image_path: str) -> Dict[str, Any]:
+    def _extract_sd_metadata(self, img: "Image.Image") -> Dict[str, Any]:
         """
         Extract detailed AI metadata using sd-parsers.
         
         Args:
-            image_path: Path to the image file
+            img: Opened PIL image
             
         Returns:
             Dictionary containing all extracted SD metadata
         """
+        # Generators only write their parameters into PNG text chunks or JPEG/WEBP EXIF
+        if img.format not in SD_METADATA_FORMATS:
+            return {'metadata_found': False, 'reason': 'format_cannot_carry_sd_params'}
+
         try:
-            prompt_info = self.parser_manager.parse(image_path)
+            prompt_info = _get_parser_manager().parse(img)
             
             if not prompt_info:
                 return {'metadata_found': False}
 
             # Extract generator information
-            generator = str(prompt_info.generator) if hasattr(prompt_info, 'generator') and prompt_info.generator else None
+            generator = getattr(prompt_info, 'generator', None)
+            generator = str(generator) if generator else None
 
             # Extract prompts
             positive_prompt = None
             negative_prompt = None
 
-            if hasattr(prompt_info, 'prompts') and prompt_info.prompts:
+            prompts = getattr(prompt_info, 'prompts', None)
+            if prompts:
                 # Combine all positive prompts
-                positive_prompt = ', '.join([p.value for p in prompt_info.prompts if hasattr(p, 'value')])
+                positive_prompt = ', '.join([p.value for p in prompts if hasattr(p, 'value')])
 
-            if hasattr(prompt_info, 'negative_prompts') and prompt_info.negative_prompts:
+            negative_prompts = getattr(prompt_info, 'negative_prompts', None)
+            if negative_prompts:
                 # Combine all negative prompts
-                negative_prompt = ', '.join([p.value for p in prompt_info.negative_prompts if hasattr(p, 'value')])
+                negative_prompt = ', '.join([p.value for p in negative_prompts if hasattr(p, 'value')])
 
             # Extract models
-            models = []
-            if hasattr(prompt_info, 'models') and prompt_info.models:
-                models = [str(m) for m in prompt_info.models]
+            models = [str(m) for m in getattr(prompt_info, 'models', None) or []]
 
             # Extract detailed sampler information
             samplers = []
-            if hasattr(prompt_info, 'samplers') and prompt_info.samplers:
-                for sampler in prompt_info.samplers:
-                    sampler_dict = {
-                        'name': str(sampler.name) if hasattr(sampler, 'name') else None,
-                        'cfg_scale': sampler.cfg_scale if hasattr(sampler, 'cfg_scale') else None,
-                        'seed': sampler.seed if hasattr(sampler, 'seed') else None,
-                        'steps': sampler.steps if hasattr(sampler, 'steps') else None,
-                        'parameters': sampler.parameters if hasattr(sampler, 'parameters') else {}
-                    }
-                    samplers.append(sampler_dict)
+            for sampler in getattr(prompt_info, 'samplers', None) or []:
+                name = getattr(sampler, 'name', None)
+                samplers.append({
+                    'name': str(name) if name is not None else None,
+                    'cfg_scale': getattr(sampler, 'cfg_scale', None),
+                    'seed': getattr(sampler, 'seed', None),
+                    'steps': getattr(sampler, 'steps', None),
+                    'parameters': getattr(sampler, 'parameters', {})
+                })
             
             # Extract raw metadata if available (often contains the full generation string)
-            raw_metadata = {}
-            if hasattr(prompt_info, 'metadata'):
-                raw_metadata = prompt_info.metadata
+            raw_metadata = getattr(prompt_info, 'metadata', {})
 
             return {
                 'metadata_found': True,
@@ -159,100 +317,79 @@ class AIMetadataAnalyzer(BaseStep):
             print(f"  [AIMetadataAnalyzer] Warning: Failed to parse SD metadata: {e}")
             return {'metadata_found': False, 'error': str(e)}
 
-    def _extract_file_metadata(self, image_path: str) -> Dict[str, Any]:
+    def _extract_file_metadata(self, img: "Image.Image", file_stats: os.stat_result) -> Dict[str, Any]:
         """
         Extract basic file and image metadata using PIL, filtering for insightful tags.
         
         Args:
-            image_path: Path to the image file
+            img: Opened PIL image
+            file_stats: os.stat() result for the image file
             
         Returns:
             Dictionary containing file system and image format metadata
         """
         try:
-            from PIL import ExifTags
-            
-            file_stats = os.stat(image_path)
             file_size = file_stats.st_size
             
-            with Image.open(image_path) as img:
-                image_format = img.format
-                image_mode = img.mode
-                image_size = img.size
-                
-                # Insightful EXIF tags to look for
-                # 271: Make, 272: Model, 305: Software, 306: DateTime
-                # 36867: DateTimeOriginal, 36868: DateTimeDigitized
-                # 42034: LensModel, 37510: UserComment
-                insightful_tags = {
-                    271: 'Make',
-                    272: 'Model',
-                    305: 'Software',
-                    306: 'DateTime',
-                    36867: 'DateTimeOriginal',
-                    36868: 'DateTimeDigitized',
-                    42034: 'LensModel',
-                    37510: 'UserComment',
-                    33432: 'Copyright',
-                    315: 'Artist'
-                }
-
-                # Get raw EXIF data and filter
-                exif_data = {}
-                if hasattr(img, 'getexif'):
-                    exif_raw = img.getexif()
-                    if exif_raw:
-                        for tag_id, value in exif_raw.items():
-                            if tag_id in insightful_tags:
-                                tag_name = insightful_tags[tag_id]
-                                # Clean up value if needed (decode bytes)
-                                if isinstance(value, bytes):
-                                    try:
-                                        value = value.decode()
-                                    except:
-                                        value = str(value)
-                                exif_data[tag_name] = str(value)
-                            
-                            # Also check for ExifTags mapping if not in our explicit list but potentially interesting
-                            elif tag_id in ExifTags.TAGS:
-                                tag_name = ExifTags.TAGS[tag_id]
-                                if tag_name in ['BodySerialNumber', 'CameraOwnerName', 'LensSpecification']:
-                                     exif_data[tag_name] = str(value)
-                
-                # Get raw PNG info and filter
-                # PNG info often contains 'parameters' (SD), 'Software', 'Comment'
-                png_info = {}
-                if hasattr(img, 'info'):
-                    for k, v in img.info.items():
-                        # Filter out large binary blobs like ICC profiles or thumbnails unless needed
-                        if k in ['icc_profile', 'exif']: 
-                            continue
-                        
-                        # Keep text-based info
-                        if isinstance(v, (str, int, float)):
-                            png_info[str(k)] = str(v)
-                        elif isinstance(v, bytes):
-                            # Try to decode short bytes, skip long ones
-                            if len(v) < 1000:
-                                try:
-                                    png_info[str(k)] = v.decode()
-                                except:
-                                    pass
-
-                return {
-                    'has_exif': bool(exif_data),
-                    'has_png_info': bool(png_info),
-                    'image_format': str(image_format),
-                    'image_mode': str(image_mode),
-                    'image_size': list(image_size),
-                    'file_size_bytes': file_size,
-                    'exif_data': exif_data,
-                    'png_info': png_info
-                }
-                
+            image_format = img.format
+            image_mode = img.mode
+            image_size = img.size
+            
+            # PNGs: read text/eXIf chunks directly instead of letting getexif() decode the pixels.
+            # Other formats (JPEG, WEBP, ...) already expose EXIF from the header parse.
+            info = img.info
+            exif_raw = None
+            if img.format == 'PNG' and getattr(img, 'filename', None):
+                png_text, png_exif = _scan_png_metadata(img.filename)
+                info = {**img.info, **png_text}
+                exif_raw = Image.Exif()
+                if png_exif:
+                    exif_raw.load(png_exif)
+            elif hasattr(img, 'getexif'):
+                exif_raw = img.getexif()
+
+            # Get raw EXIF data and filter
+            exif_data = {}
+            if exif_raw:
+                # Make/Model/Software live in IFD0, capture times, lens and serials in the Exif
+                # sub-IFD. Only those two are parsed; GPS, Interop and MakerNote are never expanded.
+                exif_ifd = exif_raw.get_ifd(EXIF_IFD_POINTER)
+                for tag_id, tag_name in _wanted_exif_tags().items():
+                    value = exif_raw.get(tag_id)
+                    if value is None:
+                        value = exif_ifd.get(tag_id)
+                    if value is None:
+                        continue
+                    # Clean up value if needed (decode bytes)
+                    if isinstance(value, bytes):
+                        try:
+                            value = value.decode()
+                        except:
+                            value = str(value)
+                    exif_data[tag_name] = str(value)
+        
+            # Get raw PNG info and filter
+            # PNG info often contains 'parameters' (SD), 'Software', 'Comment'
+            png_info = {
+                str(k): text
+                for k, v in info.items()
+                if k not in SKIPPED_INFO_KEYS and (text := _info_text(v)) is not None
+            }
+
+            return {
+                'has_exif': bool(exif_data),
+                'has_png_info': bool(png_info),
+                'image_format': str(image_format),
+                'image_mode': str(image_mode),
+                'image_size': list(image_size),
+                'file_size_bytes': file_size,
+                'exif_data': exif_data,
+                'png_info': png_info
+            }
+            
         except Exception as e:
             print(f"  [AIMetadataAnalyzer] Warning: Failed to extract file metadata: {e}")
             return {
                 'error': str(e),
-                'file_size_bytes': os.path.getsize(image_path) if os.path.exists(image_path) else 0
+                'file_size_bytes': file_stats.st_size
             }
@@ -1,7 +1,86 @@
+import asyncio
+import copy
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from core.images import image_sha256
 from core.schemas import TaskInput, StepResult
 
 class BaseStep(ABC):
     @abstractmethod
     def run(self, input_data: TaskInput) -> StepResult:
         pass
+
+    async def run_async(self, input_data: TaskInput) -> StepResult:
+        # Steps block on network I/O, so by default run them in a worker thread
+        return await asyncio.to_thread(self.run, input_data)
+
+class BatchStep:
+    """Mixin for steps that can analyze several images at once."""
+    # Upper bound on images processed at the same time (API rate limits)
+    max_concurrency = 16
+
+    def run_many(self, inputs: List[TaskInput]) -> List[StepResult]:
+        # Per-image work is I/O-bound, so threads overlap it; results keep input order
+        if not inputs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(inputs))) as pool:
+            groups = self._group_duplicates(inputs, list(pool.map(self._dedupe_key, inputs)))
+            unique_results = list(pool.map(self._run_or_error, [inputs[idxs[0]] for idxs in groups]))
+        return self._fan_out(inputs, groups, unique_results)
+
+    async def run_many_async(self, inputs: List[TaskInput]) -> List[StepResult]:
+        # Same contract as run_many, on the event loop
+        keys = await asyncio.gather(*(asyncio.to_thread(self._dedupe_key, input_data) for input_data in inputs))
+        groups = self._group_duplicates(inputs, list(keys))
+        unique_results = await self._run_unique_async([inputs[idxs[0]] for idxs in groups])
+        return self._fan_out(inputs, groups, unique_results)
+
+    async def _run_unique_async(self, inputs: List[TaskInput]) -> List[StepResult]:
+        # Runs all inputs concurrently; the semaphore bounds in-flight runs
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run_one(input_data: TaskInput) -> StepResult:
+            async with semaphore:
+                try:
+                    return await self.run_async(input_data)
+                except Exception as e:
+                    return StepResult(source=type(self).__name__, content={"error": str(e)}, success=False)
+
+        return list(await asyncio.gather(*(run_one(input_data) for input_data in inputs)))
+
+    def _run_or_error(self, input_data: TaskInput) -> StepResult:
+        # One failing image must not discard the results of the rest of the batch
+        try:
+            return self.run(input_data)
+        except Exception as e:
+            return StepResult(source=type(self).__name__, content={"error": str(e)}, success=False)
+
+    @staticmethod
+    def _dedupe_key(input_data: TaskInput) -> Tuple[str, ...]:
+        # Byte-identical images with the same text give the same result; unreadable
+        # files fall back to their path so each one reports its own error
+        try:
+            return (image_sha256(input_data.image_path), input_data.text or "")
+        except OSError:
+            return ("path", input_data.image_path, input_data.text or "")
+
+    @staticmethod
+    def _group_duplicates(inputs: List[TaskInput], keys: List[Tuple[str, ...]]) -> List[List[int]]:
+        # Input indices per unique key, in order of first appearance
+        groups: Dict[Tuple[str, ...], List[int]] = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(key, []).append(i)
+        return list(groups.values())
+
+    def _fan_out(self, inputs: List[TaskInput], groups: List[List[int]], unique_results: List[StepResult]) -> List[StepResult]:
+        results: List[StepResult] = [None] * len(inputs)
+        for idxs, result in zip(groups, unique_results):
+            results[idxs[0]] = result
+            for i in idxs[1:]:
+                results[i] = self._result_for_duplicate(result, inputs[i])
+        return results
+
+    def _result_for_duplicate(self, result: StepResult, input_data: TaskInput) -> StepResult:
+        # Each input gets its own copy; steps override this to fix per-input fields
+        return copy.deepcopy(result)
@@ -1,47 +1,119 @@
+import textwrap
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
 from typing import List, Dict
 from steps.base import BaseStep
 from core.schemas import TaskInput, StepResult
-from core.llm import query_llm
-import json
-import PIL.Image
+from core.images import get_preview
+from core.llm import FILES_API_ENABLED, LLM_ERROR_PREFIX, extract_json_object, query_llm, upload_blob
 
 class JudgeSystem(BaseStep):
+    STANCES = {
+        "Pro-Fake": "You are arguing that the image is AI-GENERATED (Deepfake).",
+        "Pro-Real": "You are arguing that the image is REAL (not a deepfake)."
+    }
+
+    # Parsed (and dedented) once; each round only substitutes the variable fields.
+    # Dedenting drops the 8-space source indentation from every line sent to the model.
+    AGENT_PROMPT = Template(textwrap.dedent("""
+        You are a Debate Agent in a forensic analysis system.
+        $stance
+        
+        Input Image Path: $image_path
+        User Text: $user_text
+        
+        Debate History:
+        $history_text
+        
+        Current Round: $round_num
+        
+        Your task:
+        1. Analyze the input and the history.
+        2. Provide a strong, concise argument supporting your stance.
+        3. Refute the opponent's points from previous rounds if applicable.
+        
+        Return ONLY your argument as plain text.
+        """))
+
+    JUDGE_PROMPT = Template(textwrap.dedent("""
+        You are the Judge Agent supervising a debate about whether an image is a deepfake.
+        
+        Input Image Path: $image_path
+        User Text: $user_text
+        
+        Debate History:
+        $history_text
+        
+        Current Round: $round_num / $max_rounds
+        
+        Your task:
+        1. Evaluate the arguments from both sides.
+        2. Decide if the debate has reached sufficient clarity to make a final decision.
+        3. If YES or if this is the final round ($max_rounds), output "TERMINATE" and your final verdict.
+        4. If NO and rounds remain, output "CONTINUE".
+        
+        Return a JSON object with this structure:
+        {
+            "decision": "TERMINATE" or "CONTINUE",
+            "reasoning": "Brief explanation of why you are terminating or continuing",
+            "final_verdict": "Real" or "Fake" or "Inconclusive" (Only required if decision is TERMINATE),
+            "explanation": "Final detailed explanation for the user" (Only required if decision is TERMINATE),
+            "probability_score": <int 0-100> (Probability of being Fake, Only required if decision is TERMINATE)
+        }
+        """))
+
     def run(self, input_data: TaskInput) -> StepResult:
         print(f"⚖️ Starting Judge System Debate for: {input_data.image_path}")
         
         try:
-            img = PIL.Image.open(input_data.image_path)
+            img = get_preview(input_data)
         except Exception as e:
             print(f"⚠️ Could not load image at {input_data.image_path}: {e}")
             img = None
 
+        if img is not None and FILES_API_ENABLED:
+            # Every round sends the image three times; upload it once and pass the handle
+            try:
+                img = upload_blob(img)
+            except Exception as e:
+                print(f"⚠️ Could not upload image, sending it inline: {e}")
+
         max_rounds = 3
         debate_history: List[Dict[str, str]] = []
+        # One formatted block per finished round, so prompts don't re-render the whole history
+        history_blocks: List[str] = []
         
         final_judgment = None
+        # Arguments or judge replies that are API errors make the verdict unreliable
+        llm_failed = False
         
         for round_num in range(1, max_rounds + 1):
             print(f"\n--- Debate Round {round_num} ---")
             
             # 1. Debate Agents
-            # Pro-Fake Agent
+            # Both agents only see the history up to the previous round, so they can argue in parallel
+            history_text = "".join(history_blocks)
             pro_fake_prompt = self._create_agent_prompt(
                 role="Pro-Fake",
                 input_data=input_data,
-                history=debate_history,
+                history_text=history_text,
                 round_num=round_num
             )
-            fake_argument = query_llm(pro_fake_prompt, images=[img] if img else None)
-            print(f"😈 Pro-Fake: {fake_argument[:100]}...")
-            
-            # Pro-Real Agent
             pro_real_prompt = self._create_agent_prompt(
                 role="Pro-Real",
                 input_data=input_data,
-                history=debate_history,
+                history_text=history_text,
                 round_num=round_num
             )
-            real_argument = query_llm(pro_real_prompt, images=[img] if img else None)
+            with ThreadPoolExecutor(max_workers=2) as debaters:
+                fake_future = debaters.submit(query_llm, pro_fake_prompt, images=[img] if img else None)
+                real_future = debaters.submit(query_llm, pro_real_prompt, images=[img] if img else None)
+                fake_argument = fake_future.result()
+                real_argument = real_future.result()
+            llm_failed = llm_failed or any(
+                argument.startswith(LLM_ERROR_PREFIX) for argument in (fake_argument, real_argument)
+            )
+            print(f"😈 Pro-Fake: {fake_argument[:100]}...")
             print(f"😇 Pro-Real: {real_argument[:100]}...")
             
             # Update History
@@ -50,98 +122,58 @@ class JudgeSystem(BaseStep):
                 "pro_fake": fake_argument,
                 "pro_real": real_argument
             })
+            history_blocks.append(f"Round {round_num}:\nPro-Fake: {fake_argument}\nPro-Real: {real_argument}\n\n")
             
             # 2. Judge Agent
             judge_prompt = self._create_judge_prompt(
                 input_data=input_data,
-                history=debate_history,
+                history_text="".join(history_blocks),
                 round_num=round_num,
                 max_rounds=max_rounds
             )
             
             judge_response = query_llm(judge_prompt, images=[img] if img else None)
+            llm_failed = llm_failed or judge_response.startswith(LLM_ERROR_PREFIX)
             
-            try:
-                # Expecting JSON from Judge
-                # Clean up potential markdown code blocks
-                cleaned_response = judge_response.replace("```json", "").replace("```", "").strip()
-                judge_decision = json.loads(cleaned_response)
-                
+            # Judges sometimes wrap the JSON in prose, so pull out the first object with a decision
+            judge_decision = extract_json_object(judge_response, required_key="decision")
+
+            if judge_decision is not None:
                 decision = judge_decision.get("decision")
-                reasoning = judge_decision.get("reasoning")
+                reasoning = judge_decision.get("reasoning") or ""
                 print(f"👨‍⚖️ Judge: {decision} - {reasoning[:100]}...")
                 
                 if decision == "TERMINATE" or round_num == max_rounds:
                     final_judgment = judge_decision
                     break
                     
-            except json.JSONDecodeError:
+            else:
                 print(f"⚠️ Judge returned invalid JSON: {judge_response}")
                 # Fallback or continue
                 if round_num == max_rounds:
-                     final_judgment = {"decision": "TERMINATE", "final_verdict": "Inconclusive", "explanation": "Judge failed to return valid JSON."}
+                     final_judgment = {"decision": "TERMINATE", "final_verdict": "Inconclusive", "explanation": "Judge failed to return valid JSON.", "error": judge_response}
 
         # Format Final Output
         return StepResult(
             source="JudgeSystem",
-            content=final_judgment
+            content=final_judgment,
+            success=final_judgment is not None and "error" not in final_judgment and not llm_failed
         )
 
-    def _create_agent_prompt(self, role: str, input_data: TaskInput, history: List[Dict], round_num: int) -> str:
-        history_text = ""
-        for h in history:
-            history_text += f"Round {h['round']}:\nPro-Fake: {h['pro_fake']}\nPro-Real: {h['pro_real']}\n\n"
-            
-        stance = "You are arguing that the image is AI-GENERATED (Deepfake)." if role == "Pro-Fake" else "You are arguing that the image is REAL (not a deepfake)."
-        
-        return f"""
-        You are a Debate Agent in a forensic analysis system.
-        {stance}
-        
-        Input Image Path: {input_data.image_path}
-        User Text: {input_data.text}
-        
-        Debate History:
-        {history_text}
-        
-        Current Round: {round_num}
-        
-        Your task:
-        1. Analyze the input and the history.
-        2. Provide a strong, concise argument supporting your stance.
-        3. Refute the opponent's points from previous rounds if applicable.
-        
-        Return ONLY your argument as plain text.
-        """
+    def _create_agent_prompt(self, role: str, input_data: TaskInput, history_text: str, round_num: int) -> str:
+        return self.AGENT_PROMPT.substitute(
+            stance=self.STANCES[role],
+            image_path=input_data.image_path,
+            user_text=input_data.text,
+            history_text=history_text,
+            round_num=round_num
+        )
 
-    def _create_judge_prompt(self, input_data: TaskInput, history: List[Dict], round_num: int, max_rounds: int) -> str:
-        history_text = ""
-        for h in history:
-            history_text += f"Round {h['round']}:\nPro-Fake: {h['pro_fake']}\nPro-Real: {h['pro_real']}\n\n"
-            
-        return f"""
-        You are the Judge Agent supervising a debate about whether an image is a deepfake.
-        
-        Input Image Path: {input_data.image_path}
-        User Text: {input_data.text}
-        
-        Debate History:
-        {history_text}
-        
-        Current Round: {round_num} / {max_rounds}
-        
-        Your task:
-        1. Evaluate the arguments from both sides.
-        2. Decide if the debate has reached sufficient clarity to make a final decision.
-        3. If YES or if this is the final round ({max_rounds}), output "TERMINATE" and your final verdict.
-        4. If NO and rounds remain, output "CONTINUE".
-        
-        Return a JSON object with this structure:
-        {{
-            "decision": "TERMINATE" or "CONTINUE",
-            "reasoning": "Brief explanation of why you are terminating or continuing",
-            "final_verdict": "Real" or "Fake" or "Inconclusive" (Only required if decision is TERMINATE),
-            "explanation": "Final detailed explanation for the user" (Only required if decision is TERMINATE),
-            "probability_score": <int 0-100> (Probability of being Fake, Only required if decision is TERMINATE)
-        }}
-        """
+    def _create_judge_prompt(self, input_data: TaskInput, history_text: str, round_num: int, max_rounds: int) -> str:
+        return self.JUDGE_PROMPT.substitute(
+            image_path=input_data.image_path,
+            user_text=input_data.text,
+            history_text=history_text,
+            round_num=round_num,
+            max_rounds=max_rounds
+        )
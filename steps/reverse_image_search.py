@@ -1,16 +1,48 @@
+import atexit
 import os
 
 import requests
 from google import genai
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-try:
-    from serpapi.google_search import GoogleSearch
-except ImportError:
-    # Fallback for older versions
-    from serpapi import GoogleSearch
-
+from core.cache import ResultCache
+from core.images import image_sha256, read_image_bytes
 from core.schemas import StepResult, TaskInput
-from steps.base import BaseStep
+from steps.base import BaseStep, BatchStep
+
+SERPAPI_SEARCH_URL = "https://serpapi.com/search.json"
+
+IMGUR_UPLOAD_URL = "https://api.imgur.com/3/image"
+
+# Shared session so Imgur and SerpAPI calls reuse keep-alive connections.
+# The pool is sized for ReverseImageSearch.run_many; 429/5xx responses are retried with backoff.
+_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({'GET'})
+)
+# The anonymous upload is not idempotent: after a 5xx or a read timeout Imgur may already
+# have stored the image, so only retry when the request never got through (connect error, 429)
+_UPLOAD_RETRY = Retry(
+    total=3,
+    read=0,
+    backoff_factor=0.5,
+    status_forcelist=(429,),
+    allowed_methods=frozenset({'POST'})
+)
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=_RETRY))
+_SESSION.mount(IMGUR_UPLOAD_URL, HTTPAdapter(pool_maxsize=16, max_retries=_UPLOAD_RETRY))
+atexit.register(_SESSION.close)
+
+# Search results for an image rarely change; reuse them for a week
+SEARCH_CACHE_TTL = 7 * 24 * 3600
+_SEARCH_CACHE = ResultCache('reverse_image_search', ttl=SEARCH_CACHE_TTL)
+
+# Formats Imgur takes directly; anything else is converted to JPEG first
+UPLOAD_PASSTHROUGH_FORMATS = {'JPEG', 'PNG'}
 
 
 def upload_image_to_host(image_path):
@@ -24,29 +56,38 @@ def upload_image_to_host(image_path):
         Publicly accessible URL of the uploaded image
     """
     # Using Imgur anonymous upload API (no API key needed)
-    # Convert image to PNG if needed (Imgur doesn't support webp)
-    import base64
     import io
 
     from PIL import Image
 
-    # Open and convert image to PNG if needed
-    img = Image.open(image_path)
-    # Convert RGBA to RGB if necessary (Imgur doesn't support RGBA)
-    if img.mode == 'RGBA':
-        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-        rgb_img.paste(img, mask=img.split()[3])  # Use alpha channel as mask
-        img = rgb_img
+    headers = {'Authorization': 'Client-ID 546c25a59c58ad7'}  # Imgur's public client ID
 
-    # Save to bytes buffer as PNG
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    image_data = buffer.getvalue()
-    image_base64 = base64.b64encode(image_data).decode('utf-8')
+    raw = read_image_bytes(image_path)
+    img = Image.open(io.BytesIO(raw))
+    # Alpha channel or a palette/grey transparency key (P, L, RGB with info['transparency'])
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    if img.format in UPLOAD_PASSTHROUGH_FORMATS and not has_alpha:
+        # Imgur accepts these as-is, so send the file bytes without re-encoding
+        files = {'image': (os.path.basename(image_path), raw, Image.MIME[img.format])}
+    else:
+        # Flatten transparency onto white if necessary (Imgur doesn't support RGBA)
+        # and re-encode as JPEG (Imgur doesn't support webp)
+        if has_alpha:
+            rgba_img = img.convert('RGBA')
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            rgb_img.paste(rgba_img, mask=rgba_img.getchannel('A'))  # Use alpha channel as mask
+            img = rgb_img
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
 
-    headers = {'Authorization': 'Client-ID 546c25a59c58ad7'}  # Imgur's public client ID
-    data = {'image': image_base64}
-    response = requests.post('https://api.imgur.com/3/image', headers=headers, data=data)
+        # JPEG is much cheaper to encode than PNG's zlib pass and is plenty for a search query
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=95)
+
+        # Send the raw bytes as multipart instead of a base64 form field (~25% smaller)
+        files = {'image': ('upload.jpg', buffer.getvalue(), 'image/jpeg')}
+
+    response = _SESSION.post(IMGUR_UPLOAD_URL, headers=headers, files=files, timeout=60)
 
     if response.status_code == 200:
         data = response.json()
@@ -57,17 +98,22 @@ def upload_image_to_host(image_path):
         raise Exception(f"Failed to upload image: {response.status_code} - {response.text}")
 
 
-def reverse_image_search(image_input, api_key="d25810ce04a9e104958cd66b7461f3de474c9a8d7f3f863df08af9a9e6682cc8"):
+def reverse_image_search(image_input, api_key=None):
     """
     Perform a Google reverse image search using SerpAPI.
 
     Args:
         image_input: URL of the image or path to a local image file
-        api_key: SerpAPI key (defaults to provided key)
+        api_key: SerpAPI key. If None, reads from SERPAPI_API_KEY environment variable.
 
     Returns:
         Dictionary containing search results, including image_results
     """
+    if api_key is None:
+        api_key = os.getenv("SERPAPI_API_KEY")
+        if api_key is None:
+            raise ValueError("SerpAPI key not provided. Set SERPAPI_API_KEY environment variable or pass api_key parameter.")
+
     params = {
         "engine": "google_reverse_image",
         "api_key": api_key
@@ -84,8 +130,9 @@ def reverse_image_search(image_input, api_key="d25810ce04a9e104958cd66b7461f3de4
         # Assume it's a URL
         params["image_url"] = image_input
 
-    search = GoogleSearch(params)
-    results = search.get_dict()
+    # Same REST call the serpapi SDK makes, but over the shared session
+    response = _SESSION.get(SERPAPI_SEARCH_URL, params=params, timeout=60)
+    results = response.json()
 
     return results
 
@@ -152,12 +199,23 @@ Analysis:"""
     return response.text
 
 
-class ReverseImageSearch(BaseStep):
+class ReverseImageSearch(BatchStep, BaseStep):
     def run(self, input_data: TaskInput) -> StepResult:
         # PUT YOUR LOGIC IN HERE
         print(f"  [Tool3] Performing reverse image search on {input_data.image_path}...")
         
         try:
+            # Same bytes -> same search results; skip the upload, SerpAPI and Gemini calls
+            cache_key = image_sha256(input_data.image_path)
+            cached = _SEARCH_CACHE.get(cache_key)
+            if cached is not None:
+                print("  Using cached reverse image search results")
+                return StepResult(
+                    source="ReverseImageSearch",
+                    content=cached['content'],
+                    summary_for_prompt=cached['summary_for_prompt']
+                )
+
             # Perform reverse image search
             search_results = reverse_image_search(input_data.image_path)
             
@@ -169,7 +227,7 @@ class ReverseImageSearch(BaseStep):
                 try:
                     gemini_response = query_gemini_with_search_results(search_results)
                     
-                    return StepResult(
+                    result = StepResult(
                         source="ReverseImageSearch",
                         content={
                             "num_results": len(image_results),
@@ -182,15 +240,27 @@ class ReverseImageSearch(BaseStep):
                                 }
                                 for img in image_results[:5]
                             ]
+                        },
+                        # The final judge only needs the analysis and where the image appeared
+                        summary_for_prompt={
+                            "num_results": len(image_results),
+                            "analysis": gemini_response,
+                            "top_sources": [img.get('source', 'Unknown source') for img in image_results[:5]]
                         }
                     )
+                    _SEARCH_CACHE.set(cache_key, {
+                        'content': result.content,
+                        'summary_for_prompt': result.summary_for_prompt
+                    })
+                    return result
                 except ValueError as e:
                     return StepResult(
                         source="ReverseImageSearch",
                         content={
                             "error": str(e),
                             "num_results": len(image_results)
-                        }
+                        },
+                        success=False
                     )
                 except Exception as e:
                     return StepResult(
@@ -198,7 +268,8 @@ class ReverseImageSearch(BaseStep):
                         content={
                             "error": f"Error calling Gemini API: {str(e)}",
                             "num_results": len(image_results)
-                        }
+                        },
+                        success=False
                     )
             else:
                 return StepResult(
@@ -206,14 +277,16 @@ class ReverseImageSearch(BaseStep):
                     content={
                         "error": "No image results found",
                         "available_keys": list(search_results.keys())
-                    }
+                    },
+                    success=False
                 )
         except Exception as e:
             return StepResult(
                 source="ReverseImageSearch",
                 content={
                     "error": f"Error performing reverse image search: {str(e)}"
-                }
+                },
+                success=False
             )
 
 
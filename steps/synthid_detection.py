@@ -15,6 +15,7 @@ from typing import Any, Dict, Optional
 
 from google import genai
 
+from core import images
 from core.schemas import StepResult, TaskInput
 from steps.base import BaseStep
 
@@ -32,8 +33,8 @@ def read_image_bytes(image_path: str) -> bytes:
     Returns:
         Image file as bytes
     """
-    with open(image_path, 'rb') as image_file:
-        return image_file.read()
+    # Shared with the other steps, so the file is only read once per run
+    return images.read_image_bytes(image_path)
 
 
 def detect_synthid_watermark_vertex_ai(
@@ -282,7 +283,8 @@ class SynthIDDetection(BaseStep):
                 source="SynthIDDetection",
                 content={
                     "error": f"Error detecting SynthID watermark: {str(e)}"
-                }
+                },
+                success=False
             )
 
 
@@ -5,33 +5,153 @@ Description: Uses Vision-Language Models to detect AI-generated images based on
              2025 state-of-the-art detection indicators targeting Diffusion Model weaknesses.
 """
 
+import asyncio
+import atexit
+import datetime
+import functools
+import hashlib
 import json
+import multiprocessing
 import os
-import base64
-from typing import Dict, Any, List, Optional
-from pathlib import Path
-from dataclasses import dataclass
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional, Tuple
+
+from core.cache import ResultCache
+from core.images import PREVIEW_MIME_TYPE, image_sha256, load_preview, read_image_bytes
+from core.llm import FILES_API_ENABLED, chunk_text, configure_genai, extract_json_object, upload_blob
+from core.schemas import StepResult, TaskInput, VisualForensicsResult
+from steps.base import BaseStep, BatchStep
+
+# Analyses keyed by image content hash + prompt/model version:
+# an in-process LRU in front of the persistent sqlite cache
+MEMORY_CACHE_SIZE = 128
+_MEMORY_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_MEMORY_CACHE_LOCK = threading.Lock()
+_RESULT_CACHE = ResultCache("visual_forensics")
+
+
+@functools.lru_cache(maxsize=4)
+def _build_model(model_name: str, system_prompt: str) -> Any:
+    """
+    Build the GenerativeModel once per (model, system prompt) and share it
+    between agent instances; the model object keeps no per-request state.
+    """
+    import google.generativeai as genai
+    return genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=system_prompt
+    )
+
+
+def _proto_schema(node: Dict[str, Any], defs: Dict[str, Any]) -> Any:
+    """Convert one node of a pydantic JSON schema to a genai.protos.Schema, keeping `required`."""
+    import google.generativeai as genai
+
+    if "$ref" in node:
+        node = defs[node["$ref"].rsplit("/", 1)[-1]]
+    fields: Dict[str, Any] = {"type_": genai.protos.Type[node["type"].upper()]}
+    if node["type"] == "object":
+        fields["properties"] = {name: _proto_schema(prop, defs) for name, prop in node["properties"].items()}
+        fields["required"] = node.get("required", [])
+    elif node["type"] == "array":
+        fields["items"] = _proto_schema(node["items"], defs)
+    return genai.protos.Schema(**fields)
+
+
+@functools.lru_cache(maxsize=1)
+def _response_schema() -> Any:
+    """
+    VisualForensicsResult as the response_schema proto. Passing the pydantic class
+    directly lets the SDK drop `required` (every field becomes optional to the model),
+    so the proto is built here and sent as-is.
+    """
+    json_schema = VisualForensicsResult.model_json_schema()
+    return _proto_schema(json_schema, json_schema.get("$defs", {}))
 
-# --- Standalone Definitions (previously in steps.base and core.schemas) ---
 
-@dataclass
-class TaskInput:
-    image_path: str
-    text: Optional[str] = None
+# Explicit Gemini context caching of the system prompt (opt-in: VF_CONTEXT_CACHE=1)
+CONTEXT_CACHE_ENABLED = os.getenv("VF_CONTEXT_CACHE", "").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+# Recreate the cache this long before it expires, so in-flight requests never hit a dead handle
+CONTEXT_CACHE_REFRESH_MARGIN = 300
+_CONTEXT_MODELS: Dict[tuple, tuple] = {}
+_CONTEXT_MODELS_LOCK = threading.Lock()
+# (model, system prompt) pairs the cache could not be created for; agents are built per
+# job, so this is remembered process-wide instead of retrying the create on every job
+_CONTEXT_CACHE_UNAVAILABLE: set = set()
 
-@dataclass
-class StepResult:
-    source: str
-    content: Any
 
-class BaseStep:
-    def run(self, input_data: TaskInput) -> StepResult:
-        raise NotImplementedError
+def _build_context_cached_model(model_name: str, system_prompt: str) -> Any:
+    """
+    GenerativeModel whose system prompt lives in a server-side CachedContent,
+    so it is uploaded once per TTL and billed at the cached-token rate.
+    """
+    import google.generativeai as genai
+
+    key = (model_name, system_prompt)
+    with _CONTEXT_MODELS_LOCK:
+        entry = _CONTEXT_MODELS.get(key)
+        if entry is not None and time.time() < entry[1]:
+            return entry[0]
+
+        cache = genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_prompt,
+            ttl=CONTEXT_CACHE_TTL
+        )
+        model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+        expires = time.time() + CONTEXT_CACHE_TTL.total_seconds() - CONTEXT_CACHE_REFRESH_MARGIN
+        _CONTEXT_MODELS[key] = (model, expires)
+        return model
+
+
+# Files at least this big are preprocessed in a separate process on the async path
+PREPROCESS_THRESHOLD = 2 * 1024 * 1024
+
+
+_PREPROCESS_POOL: Optional[ProcessPoolExecutor] = None
+_PREPROCESS_POOL_LOCK = threading.Lock()
+
 
-# --- End Standalone Definitions ---
+def _get_preprocess_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for CPU-bound image preprocessing, created on first use.
+
+    Workers are spawned rather than forked (the server process has many
+    threads); unpickling load_preview imports core.images and PIL once per worker.
+    """
+    global _PREPROCESS_POOL
+    with _PREPROCESS_POOL_LOCK:
+        if _PREPROCESS_POOL is None:
+            _PREPROCESS_POOL = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+        return _PREPROCESS_POOL
+
+
+def _discard_preprocess_pool(pool: ProcessPoolExecutor) -> None:
+    """Shut down a broken pool; the next _get_preprocess_pool() creates a fresh one."""
+    global _PREPROCESS_POOL
+    with _PREPROCESS_POOL_LOCK:
+        # Several images can see the same pool break; only the first one replaces it
+        if _PREPROCESS_POOL is pool:
+            _PREPROCESS_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+@atexit.register
+def _shutdown_preprocess_pool() -> None:
+    # One hook for whichever pool is current; discarded pools are already shut down
+    with _PREPROCESS_POOL_LOCK:
+        pool = _PREPROCESS_POOL
+    if pool is not None:
+        pool.shutdown(wait=False)
 
 
-class VisualForensicsAgent(BaseStep):
+class VisualForensicsAgent(BatchStep, BaseStep):
     """
     Visual Forensics Agent that analyzes images for signs of AI generation.
 
@@ -40,6 +160,15 @@ class VisualForensicsAgent(BaseStep):
     (Stable Diffusion, DALL-E 3, Midjourney, Flux, etc.).
     """
 
+    # Each image is one multi-second Gemini call; stay well below the API rate limit
+    max_concurrency = 8
+
+    # Images the async batch pipeline prepares ahead of the Gemini calls
+    PREFETCH_DEPTH = 2
+
+    # Longest side sent to the model; larger images are downscaled client-side
+    MAX_IMAGE_SIDE = 1536
+
     # System prompt engineered to target specific weaknesses in Diffusion Models (2025 Standard)
     SYSTEM_PROMPT = """You are an expert Visual Forensics Analyst specializing in AI-generated image detection.
 Your task is to analyze images for signs of AI generation using the latest 2025 detection methodology.
@@ -116,20 +245,7 @@ You MUST systematically evaluate the image against these five critical indicator
 
 ## Output Requirements
 
-You MUST respond with a valid JSON object in this exact structure:
-{
-  "fake_probability": <float 0.0-1.0>,
-  "reasoning_summary": "<concise summary of your analysis>",
-  "flagged_artifacts": [
-    {
-      "indicator_type": "<one of the 5 indicator names>",
-      "location": "<specific location in image>",
-      "description": "<detailed description>",
-      "severity": <float 0.0-1.0>
-    }
-  ],
-  "confidence": <float 0.0-1.0>
-}
+Your response is structured by the enforced response schema (fake_probability, reasoning_summary, flagged_artifacts, confidence).
 
 **Scoring Guidelines**:
 - fake_probability: 0.0 = certainly real, 1.0 = certainly AI-generated
@@ -142,6 +258,63 @@ You MUST respond with a valid JSON object in this exact structure:
 - **Context matters**: A few minor issues in a complex scene might be real photography; perfect smoothness might be AI
 - **Be specific**: Instead of "looks fake," say "left eye reflection shows window at 2 o'clock, right eye shows at 10 o'clock - physically impossible"
 - **Calibrate to reality**: Real photos have noise, compression artifacts, imperfect focus - these are GOOD signs
+"""
+
+    # Same framework in about half the tokens; opt-in (compact_prompt=True) until detection parity is benchmarked
+    SYSTEM_PROMPT_V2 = """You are an expert visual forensics analyst detecting AI-generated images (diffusion models: SDXL, DALL-E 3, Midjourney v6, Flux).
+
+Evaluate ALL five indicators:
+
+1. Physics & spatial logic (no 3D/physics understanding)
+- clipping: hands through clothing, hair through shoulders
+- gravity violations: clothing or hair floating unnaturally
+- objects appearing/disappearing inconsistently
+- depth contradictions: foreground behind background
+Reason about physical causality, not visual similarity.
+
+2. Lighting & specular consistency (no global illumination)
+- both eyes must reflect the same light source in the same position/shape
+- all shadows must point away from the light source
+- consistent highlights on glasses, jewelry, wet surfaces
+- subsurface scattering: reddish glow on backlit ear edges
+- conflicting shadow directions
+Trace light paths.
+
+3. Texture ("plastic skin": denoising over-smooths high frequencies)
+- wax-like skin without pores or micro-texture
+- airbrushing beyond what makeup achieves; smoother than the apparent age allows
+- opaque rather than translucent skin
+- sharp detailed/smooth transitions without a depth reason
+Compare to what photography can physically achieve.
+
+4. Anatomy & function (how things work, not just finger counts)
+- impossible poses or joint angles
+- mismatched left/right glasses or earrings
+- non-functional zippers, buttons without buttonholes, untieable laces
+- wrong finger, toe or teeth counts; limb asymmetry
+- body parts merging together
+Ask: could this exist and function?
+
+5. Semantic/contextual gaps (no narrative understanding)
+- summer flowers in snow, clothing wrong for the weather
+- impossible mixes of architectural styles, wrong signage for the location
+- crowds that don't interact naturally, vehicles without drivers
+- patterns (brick, text) degrading without perspective reason; gibberish text
+- scenarios that violate world knowledge
+
+Protocol:
+- scan every indicator, even if early signs point one way
+- weight severity: physics violations > minor texture issues
+- modern AI is very good: absence of obvious errors does not mean real
+- several weak signals can outweigh one strong signal
+- context matters: minor issues in a complex scene may be real; perfect smoothness may be AI
+- be specific, e.g. "left eye reflects a window at 2 o'clock, right eye at 10 o'clock"
+- noise, compression artifacts and imperfect focus are signs of a real photo
+
+Output follows the enforced response schema.
+- fake_probability: 0.0 = certainly real, 1.0 = certainly AI-generated
+- confidence: 0.0 = guessing, 1.0 = certain
+- severity: 0.0 = minor, 1.0 = smoking gun
 """
 
     USER_PROMPT_TEMPLATE = """Analyze this image for signs of AI generation using the Top 5 Indicators framework.
@@ -152,7 +325,7 @@ You MUST respond with a valid JSON object in this exact structure:
 3. Assess overall probability of AI generation
 4. Provide detailed reasoning
 
-**Return your analysis as a JSON object** following the exact schema provided in the system prompt.
+**Return your analysis as a JSON object** matching the response schema.
 
 **Remember**:
 - Be thorough but concise
@@ -161,13 +334,22 @@ You MUST respond with a valid JSON object in this exact structure:
 - Consider that real photos are imperfect; AI images often too perfect in wrong ways
 """
 
-    def __init__(self):
+    def __init__(self, early_exit: bool = False, compact_prompt: bool = False):
         """
         Initialize the Visual Forensics Agent.
 
+        Args:
+            early_exit: Stream the response and stop as soon as fake_probability and
+                confidence have arrived. For callers that only need the verdict; the
+                result then has an empty reasoning_summary and flagged_artifacts.
+            compact_prompt: Use the shorter SYSTEM_PROMPT_V2 instead of SYSTEM_PROMPT
+                (not yet benchmarked against it).
+
         Configuration is loaded from environment variables:
-        - GOOGLE_API_KEY: API key for Google Gemini
+        - GEMINI_API_KEY (or GOOGLE_API_KEY): API key for Google Gemini, shared with core.llm
         - LLM_MODEL: Model name (default: "gemini-2.5-pro")
+        - VF_CONTEXT_CACHE: "1" to keep the system prompt in a Gemini context cache
+        - VF_FILES_API: "1" to upload images once via the Files API and send the handle
         """
         # LLM configuration from environment
         self.model_name = os.getenv("LLM_MODEL", "gemini-2.5-pro")
@@ -175,22 +357,49 @@ You MUST respond with a valid JSON object in this exact structure:
             "temperature": 0.0,
             "max_output_tokens": 4096,
             "response_mime_type": "application/json",
+            # Enforced server-side (all fields required), so the prompt doesn't spell out the JSON layout
+            "response_schema": _response_schema(),
         }
 
+        self.system_prompt = self.SYSTEM_PROMPT_V2 if compact_prompt else self.SYSTEM_PROMPT
+
+        # Changing the prompts or the model must not serve analyses made with the old ones
+        self.prompt_version = hashlib.sha1(
+            (self.model_name + self.system_prompt + self.USER_PROMPT_TEMPLATE).encode()
+        ).hexdigest()[:8]
+
+        self.early_exit = early_exit
+        if early_exit:
+            # Truncated analyses are cached separately from full ones
+            self.prompt_version += ":early"
+
+        self.use_context_cache = CONTEXT_CACHE_ENABLED
+        self.use_files_api = FILES_API_ENABLED
+
         self._init_google_client()
 
+    def _get_model(self) -> Any:
+        """
+        Model for the next request: the context-cached one if enabled and available,
+        otherwise the plain model with the system instruction inline.
+        """
+        key = (self.model_name, self.system_prompt)
+        if self.use_context_cache and key not in _CONTEXT_CACHE_UNAVAILABLE:
+            try:
+                return _build_context_cached_model(self.model_name, self.system_prompt)
+            except Exception as e:
+                # e.g. model without caching support or prompt below the minimum cache size
+                print(f"  [VisualForensicsAgent] Context cache unavailable, sending prompt inline: {e}")
+                _CONTEXT_CACHE_UNAVAILABLE.add(key)
+        return self.model
+
     def _init_google_client(self):
         """Initialize Google Gemini client"""
         try:
-            import google.generativeai as genai
-            api_key = os.getenv("GOOGLE_API_KEY")
-            if not api_key:
-                raise ValueError("GOOGLE_API_KEY not found in environment variables")
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(
-                model_name=self.model_name,
-                system_instruction=self.SYSTEM_PROMPT
-            )
+            import google.generativeai  # noqa: F401  (fail early with the install hint below)
+            # Same key as core.llm's calls; a no-op after the first agent
+            configure_genai()
+            self.model = _build_model(self.model_name, self.system_prompt)
         except ImportError:
             raise ImportError("google-generativeai package not installed. Install with: pip install google-generativeai")
 
@@ -220,31 +429,176 @@ You MUST respond with a valid JSON object in this exact structure:
         print(f"  [VisualForensicsAgent] Analyzing image for AI generation: {input_data.image_path}...")
 
         try:
-            # Send image and prompts to Vision-Language Model
-            response_text = self._call_google(
-                image_path=input_data.image_path,
-                user_prompt=self.USER_PROMPT_TEMPLATE
-            )
+            cache_key = self._cache_key(input_data.image_path)
+            analysis_result = self._cache_get(cache_key)
 
-            # Parse JSON response
-            analysis_result = self._parse_response(response_text)
+            if analysis_result is not None:
+                print("  [VisualForensicsAgent] Using cached analysis")
+            else:
+                # Send image and prompts to Vision-Language Model
+                response_text = self._call_google(
+                    image_path=input_data.image_path,
+                    user_prompt=self.USER_PROMPT_TEMPLATE
+                )
 
-            # Add metadata
-            analysis_result['model_used'] = self.model_name
-            analysis_result['image_path'] = input_data.image_path
+                # Parse JSON response
+                analysis_result = self._parse_response(response_text)
+                self._cache_set(cache_key, analysis_result)
 
-            # Return as StepResult
-            return StepResult(
-                source="VisualForensicsAgent",
-                content=analysis_result
-            )
+            return self._to_step_result(input_data, analysis_result)
 
-        except FileNotFoundError as e:
-            raise FileNotFoundError(f"Image not found: {input_data.image_path}") from e
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Failed to parse LLM response as JSON: {e}") from e
         except Exception as e:
-            raise Exception(f"Visual forensics analysis failed: {e}") from e
+            raise self._analysis_error(input_data, e) from e
+
+    async def run_async(self, input_data: TaskInput) -> StepResult:
+        """
+        Async variant of run() built on generate_content_async.
+
+        The Gemini request runs on the event loop; only the blocking local work
+        (hashing, cache lookups, image loading) goes to worker threads, so many
+        analyses can be in flight without one thread each.
+        """
+        try:
+            return await self._finish_async(input_data, await self._prepare_async(input_data))
+        except Exception as e:
+            raise self._analysis_error(input_data, e) from e
+
+    async def _run_unique_async(self, inputs: List[TaskInput]) -> List[StepResult]:
+        """
+        Two-stage pipeline: up to max_concurrency prepare tasks hash, check the cache
+        and load the next images while up to max_concurrency consumers await Gemini.
+        Prepares run concurrently, so several large images can be downscaled in the
+        process pool at once. A prepare slot is only freed once its result is in the
+        bounded queue, so the look-ahead stays at most max_concurrency + PREFETCH_DEPTH
+        images, and disk and resize work overlaps the network calls even at
+        max_concurrency = 1.
+        """
+        results: List[Optional[StepResult]] = [None] * len(inputs)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.PREFETCH_DEPTH)
+        workers = min(self.max_concurrency, len(inputs))
+        prepare_slots = asyncio.Semaphore(workers)
+
+        async def prepare(i: int, input_data: TaskInput) -> None:
+            try:
+                try:
+                    prepared = await self._prepare_async(input_data)
+                except Exception as e:
+                    prepared = e
+                await queue.put((i, input_data, prepared))
+            finally:
+                prepare_slots.release()
+
+        async def produce() -> None:
+            tasks = []
+            for i, input_data in enumerate(inputs):
+                await prepare_slots.acquire()
+                tasks.append(asyncio.create_task(prepare(i, input_data)))
+            await asyncio.gather(*tasks)
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def consume() -> None:
+            while (item := await queue.get()) is not None:
+                i, input_data, prepared = item
+                try:
+                    if isinstance(prepared, Exception):
+                        raise prepared
+                    results[i] = await self._finish_async(input_data, prepared)
+                except Exception as e:
+                    error = self._analysis_error(input_data, e)
+                    results[i] = StepResult(source=type(self).__name__, content={"error": str(error)}, success=False)
+
+        await asyncio.gather(produce(), *(consume() for _ in range(workers)))
+        return results
+
+    async def _prepare_async(self, input_data: TaskInput) -> Tuple[str, Optional[Dict[str, Any]], Optional[List[Any]]]:
+        """Local half of an analysis: (cache key, cached analysis or None, request content or None)."""
+        print(f"  [VisualForensicsAgent] Analyzing image for AI generation: {input_data.image_path}...")
+
+        cache_key = await asyncio.to_thread(self._cache_key, input_data.image_path)
+        analysis_result = await asyncio.to_thread(self._cache_get, cache_key)
+        if analysis_result is not None:
+            return cache_key, analysis_result, None
+
+        content = await self._build_content_async(
+            image_path=input_data.image_path,
+            user_prompt=self.USER_PROMPT_TEMPLATE
+        )
+        return cache_key, None, content
+
+    async def _finish_async(self, input_data: TaskInput, prepared: Tuple[str, Optional[Dict[str, Any]], Optional[List[Any]]]) -> StepResult:
+        """Network half of an analysis: send the prepared request unless the cache had it."""
+        cache_key, analysis_result, content = prepared
+
+        if analysis_result is not None:
+            print("  [VisualForensicsAgent] Using cached analysis")
+        else:
+            response_text = await self._generate_async(content)
+            analysis_result = self._parse_response(response_text)
+            await asyncio.to_thread(self._cache_set, cache_key, analysis_result)
+
+        return self._to_step_result(input_data, analysis_result)
+
+    def _to_step_result(self, input_data: TaskInput, analysis_result: Dict[str, Any]) -> StepResult:
+        """Add per-run metadata to an analysis and wrap it as StepResult."""
+        analysis_result['model_used'] = self.model_name
+        analysis_result['image_path'] = input_data.image_path
+
+        return StepResult(
+            source="VisualForensicsAgent",
+            content=analysis_result
+        )
+
+    @staticmethod
+    def _analysis_error(input_data: TaskInput, e: Exception) -> Exception:
+        """Map a failure during analysis to the exception type run() documents."""
+        if isinstance(e, FileNotFoundError):
+            return FileNotFoundError(f"Image not found: {input_data.image_path}")
+        if isinstance(e, json.JSONDecodeError):
+            return ValueError(f"Failed to parse LLM response as JSON: {e}")
+        return Exception(f"Visual forensics analysis failed: {e}")
+
+    def _result_for_duplicate(self, result: StepResult, input_data: TaskInput) -> StepResult:
+        # Batches analyze byte-identical images once; each copy reports its own path
+        result = super()._result_for_duplicate(result, input_data)
+        if isinstance(result.content, dict) and 'image_path' in result.content:
+            result.content['image_path'] = input_data.image_path
+        return result
+
+    def _cache_key(self, image_path: str) -> str:
+        return f"{image_sha256(image_path)}:{self.prompt_version}"
+
+    def _cache_get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up an analysis in the in-memory LRU, then in the persistent cache.
+
+        Returns a copy, so callers can add per-run fields without touching the cache.
+        """
+        with _MEMORY_CACHE_LOCK:
+            if key in _MEMORY_CACHE:
+                _MEMORY_CACHE.move_to_end(key)
+                return dict(_MEMORY_CACHE[key])
+
+        result = _RESULT_CACHE.get(key)
+        if result is not None:
+            self._remember(key, result)
+            return dict(result)
+        return None
+
+    def _cache_set(self, key: str, result: Dict[str, Any]) -> None:
+        """
+        Store an analysis (without per-run fields like image_path) in both caches.
+        """
+        self._remember(key, dict(result))
+        _RESULT_CACHE.set(key, result)
+
+    @staticmethod
+    def _remember(key: str, result: Dict[str, Any]) -> None:
+        with _MEMORY_CACHE_LOCK:
+            _MEMORY_CACHE[key] = result
+            _MEMORY_CACHE.move_to_end(key)
+            while len(_MEMORY_CACHE) > MEMORY_CACHE_SIZE:
+                _MEMORY_CACHE.popitem(last=False)
 
     def _call_google(self, image_path: str, user_prompt: str) -> str:
         """
@@ -257,22 +611,150 @@ You MUST respond with a valid JSON object in this exact structure:
         Returns:
             Model's text response
         """
-        from PIL import Image
-        
-        # Open image using PIL
-        img = Image.open(image_path)
+        content = [user_prompt, self._upload_image(self._load_image(image_path))]
+
+        if self.early_exit:
+            buffer = ""
+            for chunk in self._get_model().generate_content(content, generation_config=self.generation_config, stream=True):
+                buffer += chunk_text(chunk)
+                verdict = self._early_verdict(buffer)
+                if verdict is not None:
+                    return verdict
+            return buffer
 
         # Generate content
-        response = self.model.generate_content(
-            [user_prompt, img],
+        response = self._get_model().generate_content(
+            content,
             generation_config=self.generation_config
         )
         
         return response.text
 
+    async def _build_content_async(self, image_path: str, user_prompt: str) -> List[Any]:
+        """
+        Request content for _generate_async, prepared off the event loop.
+
+        Big files that need downscaling are decoded/resized/encoded in the
+        process pool: that work is CPU-bound and would serialize on the GIL
+        when many analyses run at once.
+        """
+        if (os.path.getsize(image_path) >= PREPROCESS_THRESHOLD
+                and await asyncio.to_thread(self._needs_downscale, image_path)):
+            max_size = (self.MAX_IMAGE_SIDE, self.MAX_IMAGE_SIDE)
+            pool = _get_preprocess_pool()
+            try:
+                data = await asyncio.get_running_loop().run_in_executor(
+                    pool, load_preview, image_path, max_size
+                )
+                image = {"mime_type": PREVIEW_MIME_TYPE, "data": data}
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM); later images get a fresh pool, this one loads in a thread
+                print("  [VisualForensicsAgent] Preprocessing pool broke, recreating it")
+                _discard_preprocess_pool(pool)
+                image = await asyncio.to_thread(self._load_image, image_path)
+        else:
+            image = await asyncio.to_thread(self._load_image, image_path)
+        return [user_prompt, await asyncio.to_thread(self._upload_image, image)]
+
+    async def _generate_async(self, content: List[Any]) -> str:
+        """Same request as _call_google, awaited on the event loop."""
+        # Creating the context cache is a blocking network call; keep it off the loop
+        model = await asyncio.to_thread(self._get_model) if self.use_context_cache else self.model
+
+        if self.early_exit:
+            buffer = ""
+            stream = await model.generate_content_async(content, generation_config=self.generation_config, stream=True)
+            async for chunk in stream:
+                buffer += chunk_text(chunk)
+                verdict = self._early_verdict(buffer)
+                if verdict is not None:
+                    return verdict
+            return buffer
+
+        response = await model.generate_content_async(
+            content,
+            generation_config=self.generation_config
+        )
+        return response.text
+
+    @staticmethod
+    def _early_verdict(buffer: str) -> Optional[str]:
+        """
+        JSON for a verdict-only result once both score fields are complete in the
+        partial response, else None. The SDK sends no property ordering, and Gemini emits
+        properties alphabetically by default, so confidence and fake_probability come
+        before flagged_artifacts and reasoning_summary.
+        """
+        scores = {}
+        for field in ("fake_probability", "confidence"):
+            # A number counts as complete once the delimiter after it has arrived
+            match = re.search(rf'"{field}"\s*:\s*(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)\s*[,}}]', buffer)
+            if match is None:
+                return None
+            scores[field] = float(match.group(1))
+        return json.dumps({
+            **scores,
+            "reasoning_summary": "",
+            "flagged_artifacts": [],
+            "early_exit": True
+        })
+
+    def _needs_downscale(self, image_path: str) -> bool:
+        """True if the image is larger than MAX_IMAGE_SIDE (reads only the header)."""
+        from PIL import Image
+
+        with Image.open(image_path) as img:
+            return max(img.size) > self.MAX_IMAGE_SIDE
+
+    def _load_image(self, image_path: str) -> Any:
+        """
+        Load the image part of the request.
+
+        Images larger than MAX_IMAGE_SIDE are downscaled and sent as JPEG; Gemini
+        would shrink them anyway, so full resolution only costs upload time.
+        Other JPEG, PNG and WebP files are sent as their original bytes (a Gemini
+        inline blob), so the SDK doesn't decode them and re-encode the pixels as PNG.
+        Remaining formats go through PIL.
+        """
+        from PIL import Image
+
+        # Only the header is parsed here, straight from the file
+        img = Image.open(image_path)
+
+        if max(img.size) > self.MAX_IMAGE_SIDE:
+            img.close()
+            max_size = (self.MAX_IMAGE_SIDE, self.MAX_IMAGE_SIDE)
+            return {"mime_type": PREVIEW_MIME_TYPE, "data": load_preview(image_path, max_size)}
+
+        mime_type = self._sniff_mime_type(img.format)
+        if mime_type is not None:
+            img.close()
+            return {"mime_type": mime_type, "data": read_image_bytes(image_path)}
+
+        img.load()
+        return img
+
+    def _upload_image(self, image: Any) -> Any:
+        """
+        Files API handle for an inline blob if enabled, else the image unchanged.
+        Upload failures fall back to sending the bytes inline.
+        """
+        if not self.use_files_api or not isinstance(image, dict):
+            return image
+        try:
+            return upload_blob(image)
+        except Exception as e:
+            print(f"  [VisualForensicsAgent] Files API upload failed, sending image inline: {e}")
+            return image
+
+    @staticmethod
+    def _sniff_mime_type(image_format: Optional[str]) -> Optional[str]:
+        """Return the MIME type for formats Gemini accepts as raw bytes, else None."""
+        return {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}.get(image_format)
+
     def _parse_response(self, response_text: str) -> Dict[str, Any]:
         """
-        Parse and clean the LLM response to extract JSON.
+        Parse the LLM's JSON response and validate it against VisualForensicsResult.
 
         Args:
             response_text: Raw text response from LLM
@@ -283,39 +765,21 @@ You MUST respond with a valid JSON object in this exact structure:
         Raises:
             ValueError: If JSON cannot be extracted or is invalid
         """
-        # Try to extract JSON from response (handle markdown code blocks)
-        response_text = response_text.strip()
-
-        # Remove markdown code fences if present
-        if response_text.startswith('```'):
-            lines = response_text.split('\n')
-            # Remove first and last lines (``` markers)
-            response_text = '\n'.join(lines[1:-1])
-            # Remove 'json' language identifier if present
-            if response_text.startswith('json'):
-                response_text = response_text[4:].strip()
-
-        # Parse JSON
+        # generation_config requests application/json, so the body is plain JSON
         try:
             result = json.loads(response_text)
         except json.JSONDecodeError:
-            # Try to find JSON object in text
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}')
-            if start_idx != -1 and end_idx != -1:
-                json_str = response_text[start_idx:end_idx+1]
-                result = json.loads(json_str)
-            else:
+            # Safety net only for malformed replies; costs nothing on the normal path
+            result = extract_json_object(response_text, required_key='fake_probability')
+            if result is None:
                 raise ValueError("No valid JSON found in response")
 
-        # Validate required fields
-        required_fields = ['fake_probability', 'reasoning_summary', 'flagged_artifacts', 'confidence']
-        for field in required_fields:
-            if field not in result:
-                raise ValueError(f"Missing required field: {field}")
-
         # Ensure flagged_artifacts is a list
-        if not isinstance(result['flagged_artifacts'], list):
+        if not isinstance(result.get('flagged_artifacts'), list):
             result['flagged_artifacts'] = []
 
-        return result
+        # Same schema the model was given; pydantic's ValidationError is a ValueError
+        validated = VisualForensicsResult.model_validate(result).model_dump(mode='python')
+        if result.get('early_exit'):
+            validated['early_exit'] = True
+        return validated
@@ -1,53 +1,94 @@
-try:
-    import serpapi
-    print("Successfully imported serpapi")
-except ImportError as e:
-    print(f"Failed to import serpapi: {e}")
-
-try:
-    import google.generativeai as genai_old
-    print("Successfully imported google.generativeai")
-except ImportError as e:
-    print(f"Failed to import google.generativeai: {e}")
-
-try:
-    from core.schemas import AggregatedContext, TaskInput
-    print("Successfully imported core.schemas")
-except ImportError as e:
-    print(f"Failed to import core.schemas: {e}")
-
-try:
-    from steps.base import BaseStep
-    print("Successfully imported steps.base")
-except ImportError as e:
-    print(f"Failed to import steps.base: {e}")
-
-try:
-    from steps.reverse_image_search import ReverseImageSearch
-    print("Successfully imported steps.reverse_image_search")
-except ImportError as e:
-    print(f"Failed to import steps.reverse_image_search: {e}")
-
-try:
-    from steps.synthid_detection import SynthIDDetection
-    print("Successfully imported steps.synthid_detection")
-except ImportError as e:
-    print(f"Failed to import steps.synthid_detection: {e}")
-
-try:
-    from steps.visual_forensics import VisualForensicsAgent
-    print("Successfully imported steps.visual_forensics")
-except ImportError as e:
-    print(f"Failed to import steps.visual_forensics: {e}")
-
-try:
-    from steps.judge_system import JudgeSystem
-    print("Successfully imported steps.judge_system")
-except ImportError as e:
-    print(f"Failed to import steps.judge_system: {e}")
-
-try:
-    from steps.ai_metadata_analyzer import AIMetadataAnalyzer
-    print("Successfully imported steps.ai_metadata_analyzer")
-except ImportError as e:
-    print(f"Failed to import steps.ai_metadata_analyzer: {e}")
+import argparse
+import compileall
+import importlib
+import importlib.util
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# (module, names the pipeline imports from it)
+CHECKS = [
+    ("serpapi", []),
+    ("google.generativeai", []),
+    ("core.schemas", ["AggregatedContext", "TaskInput"]),
+    ("steps.base", ["BaseStep"]),
+    ("steps.reverse_image_search", ["ReverseImageSearch"]),
+    ("steps.synthid_detection", ["SynthIDDetection"]),
+    ("steps.visual_forensics", ["VisualForensicsAgent"]),
+    ("steps.judge_system", ["JudgeSystem"]),
+    ("steps.ai_metadata_analyzer", ["AIMetadataAnalyzer"]),
+]
+
+def check(name, attrs, deep):
+    """Return the result record for one module: {"module", "ok", "error"}."""
+    if not deep:
+        try:
+            spec = importlib.util.find_spec(name)
+        except ImportError:
+            # parent package missing
+            spec = None
+        return {"module": name, "ok": spec is not None, "error": None if spec else "not found"}
+
+    try:
+        module = importlib.import_module(name)
+        for attr in attrs:
+            getattr(module, attr)
+        return {"module": name, "ok": True, "error": None}
+    except (ImportError, AttributeError) as e:
+        return {"module": name, "ok": False, "error": str(e)}
+
+
+def format_line(record, deep):
+    """Human-readable report line for a check() record."""
+    name = record["module"]
+    if not deep:
+        return f"Successfully found {name}" if record["ok"] else f"Missing {name}"
+    if record["ok"]:
+        return f"Successfully imported {name}"
+    return f"Failed to import {name}: {record['error']}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the pipeline's modules are installed")
+    parser.add_argument("modules", nargs="*", metavar="module", help="modules to check (default: all)")
+    # Default: only check that each module can be found, without running it (fast).
+    # --deep: actually import them, which also catches missing transitive dependencies.
+    parser.add_argument("--deep", action="store_true", help="import the modules instead of only locating them")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per module (NDJSON)")
+    parser.add_argument("--warm", action="store_true", help="byte-compile core/ and steps/ first (parallel)")
+    args = parser.parse_args()
+    unknown = set(args.modules) - {name for name, _ in CHECKS}
+    if unknown:
+        parser.error(f"unknown module(s): {', '.join(sorted(unknown))}")
+
+    if args.warm:
+        # Fills __pycache__ so this and later --deep runs import straight from .pyc
+        root = os.path.dirname(os.path.abspath(__file__))
+        for package in ("core", "steps"):
+            compileall.compile_dir(os.path.join(root, package), quiet=1, workers=0)
+
+    # Modules not asked for are never located or imported
+    selected = [(name, attrs) for name, attrs in CHECKS if not args.modules or name in args.modules]
+
+    # Imports mostly wait on disk, so probing in threads takes about as long as the
+    # slowest module instead of the sum; lines are still printed in CHECKS order
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda check_args: check(*check_args, args.deep), selected))
+
+    lines = []
+    for (name, attrs), record in zip(selected, results):
+        if not record["ok"] and args.deep:
+            # A thread waiting on a shared dependency that failed in another thread can
+            # get a misleading error; failed modules are out of sys.modules, so retry alone
+            record = check(name, attrs, args.deep)
+        lines.append(json.dumps(record) if args.json else format_line(record, args.deep))
+
+    # One write for the whole report, after all probing is done
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+
+# Only probe when run as a script; importing this file (e.g. pytest collecting test_*.py) does nothing
+if __name__ == "__main__":
+    main()
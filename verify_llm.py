@@ -1,34 +1,164 @@
+import asyncio
+import functools
+import hashlib
 import os
-import json
-from core.llm import call_llm
-from core.schemas import AggregatedContext, TaskInput, StepResult
+import sys
+from typing import TYPE_CHECKING, List
 
-def verify():
-    # Setup mock data
-    image_path = "./example_data/anypic.png"
-    if not os.path.exists(image_path):
-        print(f"Error: Image not found at {image_path}")
-        return
+# core.* pulls in pydantic, PIL and the Gemini SDK; they are imported inside the
+# functions, so importing this module (e.g. during test collection) stays cheap
+if TYPE_CHECKING:
+    from core.cache import ResultCache
+    from core.schemas import AggregatedContext
+
+@functools.lru_cache(maxsize=1)
+def _llm_cache() -> "ResultCache":
+    # The mock input never changes, so repeated runs reuse the last good reply.
+    # Pass --no-cache after editing the call_llm prompt (it is not part of the key).
+    from core.cache import ResultCache
+    return ResultCache("verify_llm")
+
+EXAMPLE_DIR = "./example_data"
+
+# --json: stdout carries one JSON object per checked image (NDJSON); everything
+# else, including the streamed reply, goes to stderr
+JSON_OUTPUT = False
+
+def _log(*args, **kwargs):
+    print(*args, file=sys.stderr if JSON_OUTPUT else sys.stdout, **kwargs)
+
+def _cache_key(context: "AggregatedContext") -> str:
+    from core.images import image_sha256
+    from core.llm import MODEL
+
+    # Same image bytes, context and model -> same request
+    payload = context.model_dump_json() + image_sha256(context.task_input.image_path) + MODEL
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-    task_input = TaskInput(image_path=image_path, text="instagram")
+@functools.lru_cache(maxsize=1)
+def _mock_templates():
+    # Validated once; each mock context is a copy with the image path swapped in
+    from core.schemas import AggregatedContext, TaskInput, StepResult
+
+    task_input = TaskInput(image_path="", text="instagram")
     context = AggregatedContext(task_input=task_input)
     
     # Add some mock step results
-    context.results.append(StepResult(
+    mock_result = StepResult(
         source="MockStep",
         content={"analysis": "Suspicious artifacts found."}
-    ))
+    )
+    return context, mock_result
+
+def _mock_context(image_path: str) -> "AggregatedContext":
+    template, mock_result = _mock_templates()
+    task_input = template.task_input.model_copy(update={"image_path": image_path})
+    # Fresh results list per context; the (read-only) mock result itself is shared
+    return template.model_copy(update={"task_input": task_input, "results": [mock_result]})
 
-    print("Calling call_llm...")
-    result = call_llm(context)
-    print("\nResult:")
-    print(result)
+def _report(image_path: str, result: str, cache_key: str):
+    # Only needed once a reply is in, like the core.* imports
+    import json
 
     try:
         data = json.loads(result)
-        print(f"\nParsed Probability: {data.get('probability_score')}")
     except json.JSONDecodeError:
-        print("\nFailed to parse JSON")
+        data = None
+
+    if JSON_OUTPUT:
+        record = {"image_path": image_path, "ok": data is not None}
+        if data is not None:
+            record["probability_score"] = data.get("probability_score")
+        else:
+            record["error"] = "Failed to parse JSON"
+        print(json.dumps(record), flush=True)
+    elif data is not None:
+        _log(f"\nParsed Probability: {data.get('probability_score')}")
+    else:
+        _log("\nFailed to parse JSON")
+
+    if data is not None:
+        # Only well-formed replies are cached, never API errors
+        _llm_cache().set(cache_key, result)
+
+def verify(use_cache: bool = True):
+    from core.llm import call_llm
+
+    # Setup mock data
+    image_path = os.path.join(EXAMPLE_DIR, "anypic.png")
+    try:
+        os.stat(image_path)
+    except FileNotFoundError:
+        _log(f"Error: Image not found at {image_path}")
+        return
+
+    context = _mock_context(image_path)
+
+    cache_key = _cache_key(context)
+    result = _llm_cache().get(cache_key) if use_cache else None
+    if result is not None:
+        _log("Using cached call_llm result")
+        _log("\nResult:")
+        _log(result)
+    else:
+        _log("Calling call_llm...")
+        _log("\nResult:")
+        # Stream the reply to the terminal while it is generated instead of waiting for all of it
+        result = call_llm(context, on_chunk=lambda text: _log(text, end="", flush=True))
+        _log()
+
+    _report(image_path, result, cache_key)
+
+def verify_batch(image_paths: List[str], use_cache: bool = True):
+    from core.llm import call_llm_batch
+
+    # One mock context per image; all uncached ones go out in as few requests as possible
+    contexts = [_mock_context(path) for path in image_paths]
+    cache_keys = [_cache_key(context) for context in contexts]
+    results = [_llm_cache().get(key) if use_cache else None for key in cache_keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        _log(f"Calling call_llm_batch for {len(missing)} of {len(contexts)} images...")
+        for i, result in zip(missing, call_llm_batch([contexts[i] for i in missing])):
+            results[i] = result
+
+    for path, result, cache_key in zip(image_paths, results, cache_keys):
+        _log(f"\nResult for {path}:")
+        _log(result)
+        _report(path, result, cache_key)
+
+async def verify_async(image_paths: List[str], use_cache: bool = True, max_concurrency: int = 32):
+    from core.llm import call_llm_async
+
+    # Alternative to verify_batch: one call_llm per image, all in flight at once (up to max_concurrency)
+    contexts = [_mock_context(path) for path in image_paths]
+    cache_keys = [_cache_key(context) for context in contexts]
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def one(context: "AggregatedContext", cache_key: str) -> str:
+        result = _llm_cache().get(cache_key) if use_cache else None
+        if result is not None:
+            return result
+        async with semaphore:
+            return await call_llm_async(context)
+
+    _log(f"Calling call_llm for {len(contexts)} images concurrently...")
+    results = await asyncio.gather(*(one(context, key) for context, key in zip(contexts, cache_keys)))
+
+    for path, result, cache_key in zip(image_paths, results, cache_keys):
+        _log(f"\nResult for {path}:")
+        _log(result)
+        _report(path, result, cache_key)
 
 if __name__ == "__main__":
-    verify()
+    JSON_OUTPUT = "--json" in sys.argv[1:]
+    use_cache = "--no-cache" not in sys.argv[1:]
+    # Sweep over every example image, batched into one prompt or as concurrent requests
+    example_paths = sorted(entry.path for entry in os.scandir(EXAMPLE_DIR) if entry.is_file())
+    if "--batch" in sys.argv[1:]:
+        verify_batch(example_paths, use_cache=use_cache)
+    elif "--async" in sys.argv[1:]:
+        asyncio.run(verify_async(example_paths, use_cache=use_cache))
+    else:
+        verify(use_cache=use_cache)